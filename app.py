@@ -1,19 +1,43 @@
-from flask import Flask, request, render_template, jsonify, redirect, url_for, session
+from flask import Flask, Response, g, request, render_template, jsonify, redirect, url_for, session
 from PIL import Image, ImageEnhance, ImageFilter
 import pytesseract
-import requests
 import os
 import time
-import shelve
 import re
+import uuid
+import json
+import zipfile
+import zlib
+import shutil
+import tempfile
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from difflib import SequenceMatcher
 from functools import wraps
 import cv2
 import numpy as np
 from skimage.metrics import structural_similarity as ssim
+from card_detection import detail_side, detect_cards, find_cards
+from card_image import as_card_image, decode_reduced, match_gray
+from card_cache import CardCache, cache_key, prices_key, result_key
+from card_index import get_card_index, normalize_name
+from collector_line import crop_collector_region, normalize_collector_number, parse_collector_line
+from fingerprints import HASH_BITS, get_fingerprint_index
+from image_fetch import cache_stats, fetch_image, fetch_images
+from logs import configure_logging, get_level, get_logger, share_level, sync_level
+from metrics import API_ERRORS, CACHE_EVENTS, CANDIDATES, COLLECTOR_LOOKUPS, REQUESTS, REQUEST_SECONDS
+from metrics import add_timings, collect_timings, render as render_metrics, server_timing_header, timed, write_snapshot
+from ocr import OCRError, get_ocr_engine
+from scryfall import ScryfallError, candidate_from_card, get_scryfall_client
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'  # Needed for session management
 
+configure_logging()
+logger = get_logger('app')
+
 # Hard-coded password
 PASSWORD = "goggs"
 
@@ -24,18 +48,121 @@ if not HEROKU:
     # Set the Tesseract executable path if running locally and not in PATH
     pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 
-# Initialize the cache (using shelve for simplicity)
-CACHE_FILE = "card_cache.db"
+# Collector-line fast path: the printing read off the card's bottom-left corner is used
+# directly when the OCR'd title agrees with it, or with no title read at all when the
+# collector line parsed with at least this confidence. Otherwise images are compared.
+COLLECTOR_MIN_CONFIDENCE = float(os.getenv('COLLECTOR_MIN_CONFIDENCE', 0.75))
+TITLE_AGREEMENT = 0.75
+
+# Printings whose fingerprint is within this many bits of the closest one are
+# re-checked with SSIM, at most FINGERPRINT_TIE_BREAK of them
+FINGERPRINT_TIE_MARGIN = 8
+FINGERPRINT_TIE_BREAK = 3
+FINGERPRINT_SSIM_TIEBREAK = os.getenv('FINGERPRINT_SSIM_TIEBREAK', '1') == '1'
+
+# Debug images are only written for requests that ask for them (?debug=1), each
+# request into its own directory so concurrent uploads never overwrite each other
+DEBUG_ARTIFACTS_DIR = os.getenv('DEBUG_ARTIFACTS_DIR', 'debug_artifacts')
+
+# Batch scans: crop + OCR run in a process pool, lookups and matching in threads.
+# BATCH_CONCURRENCY bounds how many cards of one batch are in flight at once.
+# Every gunicorn worker gets its own pool of BATCH_PROCESS_WORKERS processes, so keep
+# it small: sized to the CPU count it would multiply by the number of web workers.
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 4))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 16))
+BATCH_PROCESS_WORKERS = int(os.getenv('BATCH_PROCESS_WORKERS', 2))
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+# Archive members larger than this are skipped, so a zip bomb can't exhaust memory
+BATCH_MAX_IMAGE_BYTES = int(os.getenv('BATCH_MAX_IMAGE_BYTES', 50 * 1024 * 1024))
+
+# Title crops are enlarged 2x for OCR, but never past this width
+TITLE_OCR_MAX_WIDTH = 1200
+
+# Cards found in one multi-card photo are OCR'd and matched this many at a time
+MULTI_CARD_WORKERS = int(os.getenv('MULTI_CARD_WORKERS', 4))
+
+# Send a Server-Timing header with per-stage durations on every response, or only
+# for requests with ?timing=1
+SERVER_TIMING = os.getenv('SERVER_TIMING') == '1'
+
+# Initialize the cache (SQLite in WAL mode, shared by all workers)
+card_cache = CardCache()
 
 def get_cached_card_value(card_text):
-    with shelve.open(CACHE_FILE) as cache:
-        if card_text in cache:
-            return cache[card_text]
+    return card_cache.get(cache_key(title=card_text))
+
+def cache_card_value(card_text, value, kind='card'):
+    # kind selects the TTL: 'price' for anything carrying prices, 'card' for static metadata
+    card_cache.set(cache_key(title=card_text), value, kind)
+
+def cacheable_printing(card):
+    # Printing metadata (name, set, number, image URL) hardly ever changes and is cached
+    # for the 'card' TTL; its prices go under their own key with the 'price' TTL
+    if card.get('id') and card.get('prices') is not None:
+        card_cache.set(prices_key(card['id']), card['prices'], 'price')
+    return {field: value for field, value in card.items() if field != 'prices'}
+
+def card_prices(card):
+    # Fresh candidates (local index, Scryfall) carry their prices; for printings from
+    # the metadata cache they come from the price cache or one /cards/{id} call
+    if card.get('prices') is not None:
+        return card['prices']
+    if not card.get('id'):
+        return {}
+    prices = card_cache.get(prices_key(card['id']))
+    CACHE_EVENTS.inc(cache='price', result='miss' if prices is None else 'hit')
+    if prices is not None:
+        return prices
+    try:
+        with timed('price_lookup'):
+            fresh = get_scryfall_client().card_by_id(card['id'])
+    except ScryfallError as e:
+        API_ERRORS.inc(api='scryfall_card')
+        logger.warning("Scryfall price lookup failed", extra={'id': card['id'], 'error': str(e)})
+        return {}
+    prices = (fresh or {}).get('prices') or {}
+    card_cache.set(prices_key(card['id']), prices, 'price')
+    return prices
+
+def debug_dir_for_request():
+    if request.values.get('debug', '').lower() not in ('1', 'true', 'yes'):
+        return None
+    debug_dir = os.path.join(DEBUG_ARTIFACTS_DIR, uuid.uuid4().hex)
+    os.makedirs(debug_dir, exist_ok=True)
+    return debug_dir
+
+def save_debug_image(debug_dir, filename, image):
+    # Accepts PIL images or OpenCV (BGR) arrays; a no-op unless debugging this request
+    if debug_dir is None:
+        return None
+    # Card names can contain '/' (double-faced cards) and other characters unfit for a path
+    path = os.path.join(debug_dir, re.sub(r'[^\w,.-]+', '_', filename))
+    try:
+        if isinstance(image, np.ndarray):
+            # imwrite reports failure by returning False rather than raising
+            if not cv2.imwrite(path, image):
+                raise OSError(f'cv2.imwrite could not write {path}')
+        else:
+            image.save(path)
+    except (OSError, ValueError, cv2.error) as e:
+        logger.warning("Could not save debug image", extra={'path': path, 'error': str(e)})
         return None
+    logger.debug("Debug image saved", extra={'path': path})
+    return path
 
-def cache_card_value(card_text, value):
-    with shelve.open(CACHE_FILE) as cache:
-        cache[card_text] = value
+def decode_upload(data):
+    # Decode the upload once, straight from the request bytes, into a BGR array at
+    # working resolution (large JPEGs are decoded at reduced scale, see card_image.py).
+    # Returns (image, scale from working to uploaded pixels).
+    return decode_reduced(data)
+
+def printing_of(card):
+    # Which exact printing was matched, when the candidate data says so
+    return {'set': card.get('set'), 'collector_number': card.get('collector_number')}
+
+def is_card_result(result):
+    # Only successful recognitions go into the result cache; failures are retried
+    return result is not None and 'best_match' in result
 
 def clean_text(text):
     # Remove newlines and extra spaces
@@ -86,7 +213,7 @@ def clean_ocr_text(text):
 
     return text
 
-def extract_card_title(image):
+def threshold_title_region(image, debug_dir=None):
     # Convert to grayscale if not already
     image = image.convert('L')
 
@@ -94,41 +221,134 @@ def extract_card_title(image):
     image = image.point(lambda p: p > 128 and 255)  # Simple binary thresholding
 
     # Log the size of the image
-    print(f"Image size: {image.size}")
+    logger.debug("Title region thresholded", extra={'size': image.size})
 
     # Save the thresholded image for inspection
-    image.save("thresholded_title_region.jpg")
-    print("Thresholded title region saved as 'thresholded_title_region.jpg'")
-
-    # Use Tesseract with different page segmentation mode
-    custom_config = r'--oem 3 --psm 6'  # Try PSM 6 for better block text recognition
-    text = pytesseract.image_to_string(image, config=custom_config)
+    save_debug_image(debug_dir, "thresholded_title_region.jpg", image)
+    return image
 
-    # Log the raw text extracted
-    print(f"Raw extracted text: {text}")
 
+def title_from_text(text):
     # Clean the OCR text using custom cleanup
     cleaned_text = clean_ocr_text(text)
 
-    # Log the cleaned title
-    print(f"Cleaned card title: {cleaned_text}")
+    # Log the raw text extracted and the cleaned title
+    logger.debug("OCR text", extra={'raw_text': text, 'cleaned_text': cleaned_text})
 
     # Return the first cleaned line (assumed to be the title)
     card_title = cleaned_text.splitlines()[0] if cleaned_text else ""
     return card_title
 
 
-def manual_crop_title_region(image):
-    # Convert the OpenCV image to PIL
-    pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+def read_card_text(image, debug_dir=None):
+    # OCR the title and the collector line together on the pooled engine.
+    # Returns the title and the parsed collector line (None if unreadable).
+    with timed('crop'):
+        title_image = threshold_title_region(manual_crop_title_region(image, debug_dir), debug_dir)
+        collector_image = crop_collector_region(image)
+    save_debug_image(debug_dir, "collector_region.jpg", collector_image)
+
+    try:
+        with timed('ocr'):
+            title_text, collector_text = get_ocr_engine().images_to_strings([title_image, collector_image], psm=6)
+    except OCRError as e:
+        logger.warning("OCR failed", extra={'error': str(e)})
+        return "", None
+
+    collector = parse_collector_line(collector_text)
+    logger.debug("Collector line", extra={'raw_text': collector_text, 'collector': collector})
+    return title_from_text(title_text), collector
+
+
+def title_matches(card_title, card_name):
+    # OCR titles are noisy; close enough to the name (or either face's name) counts
+    title = normalize_name(card_title)
+    names = [card_name] + card_name.split(' // ')
+    return any(SequenceMatcher(None, title, normalize_name(name)).ratio() >= TITLE_AGREEMENT for name in names)
+
+
+def lookup_printing(set_code, collector_number, lang='en'):
+    # One printing by set + collector number in the given language: local index, then
+    # cache, then Scryfall
+    card_index = get_card_index()
+    if card_index is not None:
+        with timed('index_lookup'):
+            card = card_index.printing(set_code, collector_number, lang)
+        if card:
+            return card
+
+    key = cache_key(set_code=set_code, collector_number=collector_number, lang=lang)
+    cached = card_cache.get(key)
+    CACHE_EVENTS.inc(cache='printing', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        return cached
+
+    try:
+        with timed('printing_lookup'):
+            card = get_scryfall_client().card(set_code, collector_number, lang)
+            # Scryfall doesn't have every language of every printing (or the language
+            # was misread); the default printing still names the right card
+            if card is None and lang != 'en':
+                card = get_scryfall_client().card(set_code, collector_number)
+    except ScryfallError as e:
+        API_ERRORS.inc(api='scryfall_card')
+        logger.warning("Scryfall card lookup failed", extra={'set': set_code, 'collector_number': collector_number,
+                                                             'lang': lang, 'error': str(e)})
+        return None
+    # None (404) means the OCR'd set/number isn't a real printing
+    if card is None:
+        return None
+    card = candidate_from_card(card)
+    card_cache.set(key, cacheable_printing(card), 'card')
+    return card
+
+
+def resolve_collector_printing(collector, card_title, lookup=lookup_printing):
+    # The printing named by the collector line, or None to fall back to image matching
+    if collector is None:
+        COLLECTOR_LOOKUPS.inc(result='unreadable')
+        return None
+    if not card_title and collector['confidence'] < COLLECTOR_MIN_CONFIDENCE:
+        COLLECTOR_LOOKUPS.inc(result='low_confidence')
+        return None
+
+    card = lookup(collector['set'], collector['collector_number'], collector['lang'])
+    if card is None:
+        COLLECTOR_LOOKUPS.inc(result='not_found')
+        return None
+    # A misread number can still be a real printing of some other card
+    if card_title and not title_matches(card_title, card['name']):
+        COLLECTOR_LOOKUPS.inc(result='title_mismatch')
+        logger.info("Collector line disagrees with title", extra={'title': card_title, 'card': card['name'],
+                                                                  'set': collector['set'],
+                                                                  'collector_number': collector['collector_number']})
+        return None
+    COLLECTOR_LOOKUPS.inc(result='hit')
+    return card
+
+
+def card_result(card_title, card, match):
+    return {
+        'extracted_text': card_title,
+        'best_match': card['name'],
+        'card_value': card_prices(card),
+        'printing': printing_of(card),
+        'match': match
+    }
 
+
+def manual_crop_title_region(image, debug_dir=None):
     # Define the manual crop coordinates based on standard Magic: The Gathering card layout
-    width, height = pil_image.size
+    height = image.shape[0]
     title_region_height = int(height * 0.1)  # The title typically takes up about 10% of the card height
-    title_region = pil_image.crop((0, 0, width, title_region_height))
 
-    # Resize to make the text larger for OCR
-    title_region = title_region.resize((title_region.width * 2, title_region.height * 2), Image.LANCZOS)
+    # Crop the OpenCV buffer (a view, no copy) and convert only the title strip to PIL
+    title_region = Image.fromarray(cv2.cvtColor(image[:title_region_height], cv2.COLOR_BGR2RGB))
+
+    # Resize to make the text larger for OCR (capped, so big photos aren't blown up further)
+    scale = min(2, TITLE_OCR_MAX_WIDTH / title_region.width)
+    title_region = title_region.resize((round(title_region.width * scale), round(title_region.height * scale)),
+                                       Image.LANCZOS)
     
     # Apply sharpening and contrast enhancement
     title_region = title_region.filter(ImageFilter.SHARPEN)
@@ -136,19 +356,55 @@ def manual_crop_title_region(image):
     title_region = enhancer.enhance(2)
 
     # Save the title region for inspection
-    title_region.save("manual_cropped_title_region.jpg")
-    print("Manual cropped title region saved as 'manual_cropped_title_region.jpg'")
+    save_debug_image(debug_dir, "manual_cropped_title_region.jpg", title_region)
 
     return title_region
 
 
+@app.before_request
+def start_request_timer():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+    sync_level()
+
 @app.after_request
 def add_header(response):
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
+
+    # Streamed responses (/upload/batch) are counted when the view returns
+    endpoint = request.endpoint or 'unknown'
+    if 'request_started' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if SERVER_TIMING or request.args.get('timing') == '1':
+        server_timing = server_timing_header()
+        if server_timing:
+            response.headers['Server-Timing'] = server_timing
+    write_snapshot()
     return response
 
+@app.route('/metrics')
+def metrics():
+    # Prometheus text exposition format
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/log-level', methods=['GET', 'POST'])
+@login_required
+def log_level():
+    # Change the log level of every worker, e.g. POST level=debug; the others pick it
+    # up within LOG_LEVEL_CHECK_INTERVAL seconds
+    if request.method == 'POST':
+        try:
+            share_level(request.values.get('level', ''))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except OSError as e:
+            return jsonify({'error': f'Could not share the log level: {e}'}), 500
+        logger.warning("Log level changed", extra={'new_level': get_level()})
+    return jsonify({'level': get_level()})
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -169,52 +425,6 @@ def logout():
 def index():
     return render_template('index.html')
 
-def detect_card_and_crop(image_path):
-    # Load the image using OpenCV
-    image = cv2.imread(image_path)
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-    # Apply edge detection to find the card
-    edges = cv2.Canny(gray, 50, 150)
-    
-    # Find contours based on the edges
-    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    # Find the largest contour which should correspond to the card
-    largest_contour = max(contours, key=cv2.contourArea)
-
-    # Get the bounding box for the largest contour
-    x, y, w, h = cv2.boundingRect(largest_contour)
-
-    # Crop the image to the bounding box
-    cropped_image = image[y:y+h, x:x+w]
-    
-    # Convert the cropped image back to PIL for further processing
-    cropped_pil_image = Image.fromarray(cv2.cvtColor(cropped_image, cv2.COLOR_BGR2RGB))
-
-    # Save the full cropped card for inspection
-    cropped_pil_image.save("full_cropped_card.jpg")
-    print("Full cropped card saved as 'full_cropped_card.jpg'")
-
-    # Manually crop the top portion where the title is located
-    cropped_width, cropped_height = cropped_pil_image.size
-    title_region = cropped_pil_image.crop((0, 0, cropped_width, int(cropped_height * 0.25)))  # Increase to 25%
-
-    # Resize to make the text larger for OCR
-    title_region = title_region.resize((title_region.width * 2, title_region.height * 2), Image.LANCZOS)
-    
-    # Apply sharpening and contrast enhancement
-    title_region = title_region.filter(ImageFilter.SHARPEN)
-    enhancer = ImageEnhance.Contrast(title_region)
-    title_region = enhancer.enhance(2)
-
-    # Save the updated title region for inspection
-    title_region.save("updated_title_region.jpg")
-    print("Updated title region saved as 'updated_title_region.jpg'")
-
-    return title_region
-
-
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
@@ -226,121 +436,562 @@ def upload_file():
         return jsonify({'error': 'No selected file'})
     
     if file:
-        # Save the file locally for OpenCV processing
-        image_path = 'temp_card_image.jpg'
-        file.save(image_path)
-        
-        # Load the image using OpenCV
-        image = cv2.imread(image_path)
-
-        # Manually crop the title region based on a fixed percentage of the card's height
-        title_region = manual_crop_title_region(image)
-
-        # Extract the card title from the cropped image
-        card_title = extract_card_title(title_region)
-        
-        # Log the extracted title
-        print(f"Extracted card title: {card_title}")
-        
-        if card_title:
-            # Fetch all versions of the card using the extracted title
-            best_card = find_best_match(file, card_title)
-            
-            if best_card:
-                # Log the matched card information in the console
-                print(f"Best matched card: {best_card['name']}")
-                print(f"USD price: {best_card['prices']['usd']}")
-                print(f"Foil USD price: {best_card['prices']['usd_foil']}")
-                print(f"Similarity score: {best_card['similarity_score']}")
-
-                return jsonify({
-                    'extracted_text': card_title,
-                    'best_match': best_card['name'],
-                    'card_value': best_card['prices']
-                })
-            else:
-                print("No matching card found")
-                return jsonify({'error': 'No matching card found'})
+        data = file.read()
+        debug_dir = debug_dir_for_request()
+
+        # Identical uploads are answered from the result cache, and concurrent identical
+        # uploads (in any worker) wait for the first one instead of redoing the work.
+        # Debug requests always run the pipeline so their artifacts get written.
+        if debug_dir is not None:
+            result = recognize_card(data, debug_dir)
+        else:
+            result = cached_result(result_key(data), lambda: recognize_card(data), is_card_result)
+        return jsonify(result)
+
+
+def cached_result(key, compute, cacheable):
+    # Result cache lookup that also counts whether the work had to be done
+    computed = []
+
+    def compute_and_mark():
+        computed.append(True)
+        return compute()
+
+    result = card_cache.get_or_compute(key, compute_and_mark, cacheable=cacheable)
+    CACHE_EVENTS.inc(cache='result', result='miss' if computed else 'hit')
+    return result
+
+
+def recognize_card(data, debug_dir=None):
+    # Decode the upload once; every stage below works on this buffer
+    with timed('decode'):
+        image, scale = decode_upload(data)
+    if image is None:
+        return {'error': 'Could not read image'}
+    save_debug_image(debug_dir, "uploaded_card.jpg", image)
+    return recognize_card_image(crop_to_card(data, image, scale, debug_dir), debug_dir)
+
+
+def detect_upload_cards(data, image, scale):
+    # Cards are found on the working image, but warped from a decode of the upload
+    # detailed enough to give the smallest of them CARD_SIZE real pixels (at most the
+    # full photo): on a binder page each card is only a few hundred working pixels
+    # tall, too few for the collector line
+    with timed('detect'):
+        quads = find_cards(image)
+    source = None
+    working_side = max(image.shape[:2])
+    side = min(detail_side(image, quads), round(working_side * scale))
+    if quads and side > working_side:
+        with timed('decode'):
+            source, _ = decode_reduced(data, max_side=side)
+    with timed('detect'):
+        return detect_cards(image, source=source, quads=quads)
+
+
+def crop_to_card(data, image, scale, debug_dir=None):
+    # The title and collector crops and the fingerprints all assume an upright card
+    # filling the image: warp the largest card in the photo to that, or keep the whole
+    # frame when no card outline is found (e.g. a scan already cropped to the card)
+    cards = detect_upload_cards(data, image, scale)
+    if not cards:
+        logger.debug("No card outline found, using the whole image")
+        return image
+    card = max(cards, key=lambda card: cv2.contourArea(np.array(card['polygon'], dtype=np.float32)))
+    save_debug_image(debug_dir, "warped_card.jpg", card['image'])
+    return card['image']
+
+
+def recognize_card_image(image, debug_dir=None):
+    # Read the title (top of the card) and the collector line (bottom-left corner)
+    card_title, collector = read_card_text(image, debug_dir)
+
+    # Log the extracted title
+    logger.info("Extracted card title", extra={'title': card_title})
+
+    # Set code + collector number name the exact printing: no candidate downloads
+    printing = resolve_collector_printing(collector, card_title)
+    if printing:
+        logger.info("Matched by collector number", extra={
+            'card': printing['name'],
+            'set': printing['set'],
+            'collector_number': printing['collector_number'],
+        })
+        return card_result(card_title, printing, 'collector_number')
+
+    if card_title:
+        # Fetch all versions of the card using the extracted title
+        best_card = find_best_match(image, card_title, debug_dir)
+
+        if best_card:
+            # Log the matched card information
+            logger.info("Best matched card", extra={
+                'card': best_card['name'],
+                'usd': best_card['prices'].get('usd'),
+                'usd_foil': best_card['prices'].get('usd_foil'),
+                'similarity_score': best_card['similarity_score'],
+            })
+
+            return card_result(card_title, best_card, 'image')
+        else:
+            logger.info("No matching card found", extra={'title': card_title})
+            return {'error': 'No matching card found'}
+    else:
+        logger.info("No card title found")
+        return {'error': 'No card title found'}
+
+
+@app.route('/upload/multi', methods=['POST'])
+@login_required
+def upload_multi():
+    # One photo of several cards (a binder page, a table spread): every card found is
+    # recognized separately and returned with its outline in the photo
+    if 'file' not in request.files or request.files['file'].filename == '':
+        return jsonify({'error': 'No file part'})
+
+    data = request.files['file'].read()
+    debug_dir = debug_dir_for_request()
+    if debug_dir is not None:
+        result = recognize_cards(data, debug_dir)
+    else:
+        result = cached_result(result_key(data) + ':cards', lambda: recognize_cards(data),
+                               lambda result: any(map(is_card_result, result.get('cards', []))))
+    return jsonify(result)
+
+
+def recognize_cards(data, debug_dir=None):
+    with timed('decode'):
+        image, scale = decode_upload(data)
+    if image is None:
+        return {'error': 'Could not read image'}
+
+    cards = detect_upload_cards(data, image, scale)
+    logger.info("Detected cards", extra={'count': len(cards)})
+    if not cards:
+        return {'error': 'No cards found', 'cards': []}
+
+    def recognize(numbered_card):
+        number, card = numbered_card
+        card_debug_dir = None
+        if debug_dir is not None:
+            card_debug_dir = os.path.join(debug_dir, f'card_{number}')
+            os.makedirs(card_debug_dir, exist_ok=True)
+            save_debug_image(card_debug_dir, "warped_card.jpg", card['image'])
+        with collect_timings() as timings:
+            result = recognize_card_image(card['image'], card_debug_dir)
+        # Detection ran at working resolution; report the outline in the uploaded photo
+        polygon = [[round(x * scale), round(y * scale)] for x, y in card['polygon']]
+        return {'polygon': polygon, **result}, timings
+
+    # OCR (pooled engine) and matching (network, cv2) both release the GIL. Stage
+    # timings are summed over all cards, as for any stage that runs more than once.
+    results = []
+    with ThreadPoolExecutor(max_workers=MULTI_CARD_WORKERS, thread_name_prefix='multi') as executor:
+        for result, timings in executor.map(recognize, enumerate(cards, 1)):
+            add_timings(timings)
+            results.append(result)
+    return {'cards': results}
+
+
+def scan_card_bytes(data):
+    # Runs in the batch process pool: decode, crop and OCR one card. Returns the title,
+    # the parsed collector line, a match-sized copy of the card so the parent never
+    # decodes the full image, the stage timings for the parent to record and an error
+    # message (None on success).
+    sync_level()
+    with collect_timings() as timings:
+        try:
+            with timed('decode'):
+                image, _ = decode_reduced(data)
+            if image is None:
+                return None, None, None, timings, 'Could not read image'
+            card_title, collector = read_card_text(image)
+            return card_title, collector, as_card_image(image).match, timings, None
+        except Exception:
+            # Never let an exception cross the process boundary: one the parent can't
+            # unpickle breaks the whole pool, failing every other card in flight
+            logger.exception("Batch scan failed in worker process")
+            return None, None, None, timings, 'Scan failed'
+
+
+_scan_executor = None
+_scan_executor_lock = threading.Lock()
+
+def get_scan_executor():
+    # Spawned rather than forked: the web worker already runs threads of its own
+    global _scan_executor
+    with _scan_executor_lock:
+        if _scan_executor is None:
+            _scan_executor = ProcessPoolExecutor(max_workers=BATCH_PROCESS_WORKERS,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+    return _scan_executor
+
+
+def reset_scan_executor(broken):
+    # A worker that dies (out of memory, a crash in native code) breaks the whole pool
+    # for good; the first caller to notice drops it and the next scan starts a new one
+    global _scan_executor
+    with _scan_executor_lock:
+        if _scan_executor is broken:
+            _scan_executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def run_in_scan_pool(fn, *args):
+    # Retried once on a fresh pool: the crash may have been another card's. If the
+    # retry breaks the pool too, this card is the likely cause and the error is raised.
+    for attempt in range(2):
+        executor = get_scan_executor()
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            logger.warning("Batch scan process pool broke, restarting it", extra={'attempt': attempt + 1})
+            reset_scan_executor(executor)
+            if attempt:
+                raise
+
+
+def spool_uploads(files):
+    # Flask closes the request's files once the view returns, before a streamed
+    # response is generated, so copy them to temp files the generator owns
+    spooled = []
+    for file in files:
+        if not file or file.filename == '':
+            continue
+        stream = tempfile.TemporaryFile()
+        shutil.copyfileobj(file.stream, stream)
+        stream.seek(0)
+        spooled.append((file.filename, stream))
+    return spooled
+
+
+def read_archive_member(archive, member):
+    # The header's file_size can lie, so the limit is enforced on what is decompressed
+    if member.file_size > BATCH_MAX_IMAGE_BYTES:
+        raise ValueError('Image too large')
+    try:
+        with archive.open(member) as f:
+            data = f.read(BATCH_MAX_IMAGE_BYTES + 1)
+    except (zipfile.BadZipFile, zlib.error, EOFError, OSError):
+        raise ValueError('Could not read archive member')
+    if len(data) > BATCH_MAX_IMAGE_BYTES:
+        raise ValueError('Image too large')
+    return data
+
+
+def unreadable(message):
+    def read():
+        raise ValueError(message)
+    return read
+
+
+def iter_batch_uploads(spooled):
+    # Yields (filename, read) pairs; zip archives are expanded into their images.
+    # read() raises ValueError with a message for the client when the file is unusable.
+    for filename, stream in spooled:
+        if filename.lower().endswith('.zip') or zipfile.is_zipfile(stream):
+            stream.seek(0)
+            try:
+                archive = zipfile.ZipFile(stream)
+                members = archive.infolist()
+            except (zipfile.BadZipFile, OSError):
+                yield filename, unreadable('Not a valid zip archive')
+                continue
+            for member in members:
+                if not member.is_dir() and member.filename.lower().endswith(BATCH_IMAGE_EXTENSIONS):
+                    yield member.filename, lambda member=member, archive=archive: read_archive_member(archive, member)
         else:
-            print("No card title found")
-            return jsonify({'error': 'No card title found'})
+            stream.seek(0)
+            yield filename, stream.read
+
+
+def scan_batch_item(filename, data, lookups, lookups_lock):
+    # Shares the result cache (and its coalescing) with single uploads
+    result = cached_result(result_key(data), lambda: scan_batch_card(data, lookups, lookups_lock), is_card_result)
+    return {'file': filename, **result}
+
+
+def scan_batch_card(data, lookups, lookups_lock):
+    try:
+        card_title, collector, match_image, timings, error = run_in_scan_pool(scan_card_bytes, data)
+    except BrokenProcessPool:
+        return {'error': 'Scan process crashed'}
+    add_timings(timings, observe=True)
+    if error:
+        return {'error': error}
+
+    # Titles and printings repeat a lot within a box; only the first card with a given
+    # key looks it up, the rest wait for its answer
+    def shared_lookup(key, lookup_fn):
+        with lookups_lock:
+            lookup = lookups.get(key)
+            owner = lookup is None
+            if owner:
+                lookup = lookups[key] = Future()
+        if owner:
+            try:
+                lookup.set_result(lookup_fn())
+            except Exception as e:
+                lookup.set_exception(e)
+        return lookup.result()
+
+    def shared_printing_lookup(set_code, collector_number, lang):
+        return shared_lookup(cache_key(set_code=set_code, collector_number=collector_number, lang=lang),
+                             lambda: lookup_printing(set_code, collector_number, lang))
+
+    printing = resolve_collector_printing(collector, card_title, lookup=shared_printing_lookup)
+    if printing:
+        return card_result(card_title, printing, 'collector_number')
+
+    if not card_title:
+        return {'error': 'No card title found'}
+
+    card_versions = shared_lookup(cache_key(title=card_title), lambda: fetch_card_images(card_title))
+    best_card = find_best_match(match_image, card_title, card_versions=card_versions)
+    if not best_card:
+        return {'extracted_text': card_title, 'error': 'No matching card found'}
+    return card_result(card_title, best_card, 'image')
+
+
+def stream_batch(uploads, concurrency):
+    # Runs the scans with at most `concurrency` cards in flight and yields one NDJSON
+    # line per card as it finishes. Being a generator gives backpressure for free: no
+    # more cards are read or submitted while the client hasn't consumed the last line.
+    lookups = {}
+    lookups_lock = threading.Lock()
+    in_flight = {}
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+        while True:
+            while not exhausted and len(in_flight) < concurrency:
+                try:
+                    filename, read = next(uploads)
+                except StopIteration:
+                    exhausted = True
+                    break
+                # A bad file is reported on its own line; the rest of the batch goes on
+                try:
+                    data = read()
+                except ValueError as e:
+                    yield json.dumps({'file': filename, 'error': str(e)}) + '\n'
+                    continue
+                future = executor.submit(scan_batch_item, filename, data, lookups, lookups_lock)
+                in_flight[future] = filename
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.exception("Batch scan failed", extra={'file': filename})
+                    result = {'file': filename, 'error': 'Scan failed'}
+                yield json.dumps(result) + '\n'
+
+
+@app.route('/upload/batch', methods=['POST'])
+@login_required
+def upload_batch():
+    spooled = spool_uploads(request.files.getlist('files') + request.files.getlist('file'))
+    if not spooled:
+        return jsonify({'error': 'No file part'})
+
+    try:
+        concurrency = int(request.values.get('concurrency', BATCH_CONCURRENCY))
+    except ValueError:
+        concurrency = BATCH_CONCURRENCY
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+
+    def generate():
+        try:
+            yield from stream_batch(iter_batch_uploads(spooled), concurrency)
+        finally:
+            for _, stream in spooled:
+                stream.close()
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/revalue', methods=['POST'])
+@login_required
+def revalue():
+    # Current prices for a list of known printings (e.g. a collection scanned earlier):
+    # {"cards": [{"set": "cma", "collector_number": "184"}, ...]}
+    identifiers = (request.get_json(silent=True) or {}).get('cards')
+    if not isinstance(identifiers, list):
+        return jsonify({'error': 'Expected a JSON body with a "cards" list'}), 400
+    if not all(isinstance(i, dict) and i.get('set') and i.get('collector_number') for i in identifiers):
+        return jsonify({'error': 'Every card needs "set" and "collector_number"'}), 400
+    try:
+        return jsonify({'cards': revalue_printings(identifiers)})
+    except ScryfallError as e:
+        API_ERRORS.inc(api='scryfall_collection')
+        logger.warning("Scryfall collection lookup failed", extra={'error': str(e)})
+        return jsonify({'error': 'Price lookup failed'}), 502
+
+
+def revalue_printings(identifiers):
+    # Cached prices where still fresh; everything else in /cards/collection calls of
+    # up to 75 printings each instead of one request per card. Numbers are normalized
+    # like scanned ones, so "0002" finds the printing cached (and stored) as "2".
+    printings = [(str(i['set']).strip().lower(), normalize_collector_number(i['collector_number']))
+                 for i in identifiers]
+    keys = [cache_key(set_code=set_code, collector_number=number) for set_code, number in printings]
+    found = {}
+    for key in set(keys):
+        # The printing's metadata outlives its prices; both are needed here
+        cached = card_cache.get(key)
+        prices = card_cache.get(prices_key(cached['id'])) if cached and cached.get('id') else None
+        CACHE_EVENTS.inc(cache='printing', result='miss' if prices is None else 'hit')
+        if prices is not None:
+            found[key] = {**cached, 'prices': prices}
+
+    missing = {key: {'set': set_code, 'collector_number': number}
+               for (set_code, number), key in zip(printings, keys) if key not in found}
+    if missing:
+        with timed('collection_lookup'):
+            cards, _ = get_scryfall_client().collection(list(missing.values()))
+        for card in map(candidate_from_card, cards):
+            key = cache_key(set_code=card['set'], collector_number=card['collector_number'])
+            card_cache.set(key, cacheable_printing(card), 'card')
+            found[key] = card
+
+    results = []
+    for identifier, key in zip(identifiers, keys):
+        card = found.get(key)
+        if card is None:
+            results.append({**identifier, 'error': 'Card not found'})
+        else:
+            results.append({**printing_of(card), 'name': card['name'], 'card_value': card['prices']})
+    return results
 
 
 def fetch_card_images(card_name):
-    api_url = "https://api.scryfall.com/cards/search"
-    params = {'q': f'{card_name}', 'unique': 'prints', 'order': 'usd'}
-    response = requests.get(api_url, params=params)
+    # Resolve the title against the local card index first; it tolerates OCR noise
+    # and needs no network call
+    card_index = get_card_index()
+    if card_index is not None:
+        with timed('index_lookup'):
+            card_images = card_index.lookup_printings(card_name)
+        if card_images:
+            return card_images
+        logger.info("No local index match, falling back to Scryfall search", extra={'title': card_name})
+
+    # Search results are cached as printing metadata; prices are looked up separately
+    # for the printing that matches (see card_prices)
+    cached = get_cached_card_value(card_name)
+    CACHE_EVENTS.inc(cache='search', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        logger.debug("Using cached search results", extra={'title': card_name})
+        return cached
+
+    # Every page of results; double-faced cards are matched on their front face
+    try:
+        with timed('search'):
+            cards = get_scryfall_client().search(card_name, unique='prints', order='usd')
+    except ScryfallError as e:
+        API_ERRORS.inc(api='scryfall_search')
+        logger.warning("Scryfall search failed", extra={'title': card_name, 'error': str(e)})
+        return []
     card_images = []
-    if response.status_code == 200:
-        data = response.json()
-        for card in data['data']:
-            if 'image_uris' in card:  # Check if the image_uris field exists
-                card_images.append({
-                    'image_url': card['image_uris']['normal'],
-                    'prices': card['prices'],
-                    'name': card['name']
-                })
-            else:
-                print(f"Skipping card {card['name']} due to missing image_uris")
+    for card in map(candidate_from_card, cards):
+        if card['image_url']:
+            card_images.append(card)
+        else:
+            logger.debug("Skipping card without an image", extra={'card': card['name']})
+    if card_images:
+        cache_card_value(card_name, [cacheable_printing(card) for card in card_images])
     return card_images
 
 def download_image(image_url):
-    response = requests.get(image_url, stream=True)
-    img = Image.open(response.raw)
-    return np.array(img)
+    # Served from the local image cache when possible (BGR, downscaled)
+    return fetch_image(image_url)
 
 def compare_images(image1, image2):
-    # Resize images to the same size
-    image1 = cv2.resize(image1, (250, 350))
-    image2 = cv2.resize(image2, (250, 350))
+    # Both images in grayscale at the same size; a CardImage keeps its converted
+    # version, so the upload is only resized once however many printings it's compared to
+    gray1 = match_gray(image1)
+    gray2 = match_gray(image2)
 
-    # Convert images to grayscale for better comparison
-    gray1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
-    gray2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
+    # Compare using Structural Similarity Index (SSIM); only the mean score is needed
+    return ssim(gray1, gray2)
 
-    # Compare using Structural Similarity Index (SSIM)
-    score, _ = ssim(gray1, gray2, full=True)
-    return score
-
-def find_best_match(uploaded_image, card_name):
-    print(f"Fetching card images for: {card_name}")
+def find_best_match(uploaded_image, card_name, debug_dir=None, card_versions=None):
+    logger.debug("Fetching card images", extra={'title': card_name})
     
-    # Fetch all versions of the card
-    card_versions = fetch_card_images(card_name)
+    # Fetch all versions of the card (unless the caller already looked them up)
+    if card_versions is None:
+        card_versions = fetch_card_images(card_name)
     
     if not card_versions:
-        print("No card versions found from API")
+        logger.info("No card versions found", extra={'title': card_name})
         return None
+    CANDIDATES.observe(len(card_versions))
+    uploaded_image = as_card_image(uploaded_image)
     
     best_match = None
     highest_similarity = 0
-    
-    for version in card_versions:
-        card_image = download_image(version['image_url'])
-        similarity_score = compare_images(np.array(Image.open(uploaded_image)), card_image)
-        
-        # Log each comparison score
-        print(f"Comparing with card: {version['name']}, similarity score: {similarity_score}")
-        
-        if similarity_score > highest_similarity:
-            highest_similarity = similarity_score
-            best_match = version
+
+    # Rank by precomputed fingerprints first; only close calls and printings that
+    # haven't been fingerprinted yet need a download and an SSIM pass
+    fingerprint_index = get_fingerprint_index()
+    if fingerprint_index is not None:
+        with timed('fingerprint'):
+            ranked = fingerprint_index.rank(uploaded_image.match, [version.get('id') for version in card_versions])
+        unindexed = [version for version in card_versions if version.get('id') not in fingerprint_index]
+        if ranked:
+            by_id = {version.get('id'): version for version in card_versions}
+            best_distance = ranked[0][1]
+            close = [by_id[card_id] for card_id, distance in ranked[:FINGERPRINT_TIE_BREAK]
+                     if distance - best_distance <= FINGERPRINT_TIE_MARGIN]
+            logger.debug("Closest fingerprint", extra={'card': close[0]['name'], 'distance': best_distance})
+            if not FINGERPRINT_SSIM_TIEBREAK:
+                close = close[:1]
+            if len(close) == 1 and not unindexed:
+                best_match = close[0]
+                highest_similarity = 1 - best_distance / HASH_BITS
+            # SSIM scores aren't comparable with fingerprint distances, so anything
+            # that still needs SSIM is compared together with the fingerprint winners
+            card_versions = close + unindexed if best_match is None else []
+
+    # Download the remaining candidates concurrently (or read them from the cache)
+    with timed('download'):
+        card_images = fetch_images([version['image_url'] for version in card_versions])
+    best_image = None
+    logger.debug("Image cache counters", extra=cache_stats())
+
+    with timed('ssim'):
+        for version, card_image in zip(card_versions, card_images):
+            if card_image is None:
+                continue
+            similarity_score = compare_images(uploaded_image, card_image)
+
+            # Log each comparison score
+            logger.debug("Compared with printing", extra={'card': version['name'], 'similarity_score': similarity_score})
+
+            if similarity_score > highest_similarity:
+                highest_similarity = similarity_score
+                best_match = version
+                best_image = card_image
     
     if best_match:
-        print(f"Best match: {best_match['name']} with score: {highest_similarity}")
-
-        # Save the best-matched card's image locally for verification
-        best_image_url = best_match['image_url']
-        response = requests.get(best_image_url, stream=True)
-        best_image = Image.open(response.raw)
+        logger.debug("Best match", extra={'card': best_match['name'], 'similarity_score': highest_similarity})
 
-        best_image_path = f"best_matched_card_{best_match['name'].replace(' ', '_')}.jpg"
-        best_image.save(best_image_path)
-        print(f"Best matched card image saved as '{best_image_path}'")
+        # Save the best-matched card's image for verification; it's already in memory
+        # or in the image cache, so this never downloads it again
+        best_image_path = None
+        if debug_dir is not None:
+            if best_image is None:
+                best_image = download_image(best_match['image_url'])
+            best_image_path = save_debug_image(
+                debug_dir, f"best_matched_card_{best_match['name']}.jpg", best_image)
 
         return {
             'name': best_match['name'],
-            'prices': best_match['prices'],
+            'prices': card_prices(best_match),
+            'set': best_match.get('set'),
+            'collector_number': best_match.get('collector_number'),
             'similarity_score': highest_similarity,
             'image_path': best_image_path  # Add image path to the result
         }
@@ -349,5 +1000,5 @@ def find_best_match(uploaded_image, card_name):
 
 
 if __name__ == '__main__':
-    print("Running the Flask app...")
+    logger.info("Running the Flask app...")
     app.run(debug=True)
@@ -0,0 +1,313 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from logs import configure_logging, get_logger
+from scryfall_standin import FIXTURES_DIR, StandinServer
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak RSS is then left out
+    resource = None
+
+logger = get_logger('benchmark')
+
+# Offline benchmark for the recognition pipeline.
+#
+# Runs /upload over a directory of labelled card photos with Scryfall replaced by the
+# local stand-in (scryfall_standin.py), and reports per-stage p50/p95 latency, requests
+# per second at each worker count, peak RSS and title/printing accuracy as JSON.
+#
+# The corpus directory holds the photos plus a labels.json:
+#   {"IMG_0001.jpg": {"name": "Lightning Bolt", "set": "m10", "collector_number": "146"}, ...}
+# "set" and "collector_number" are optional; without them a photo only counts towards
+# title accuracy.
+#
+# Record fixtures once (this is the only step that talks to Scryfall), then replay:
+#   python benchmark.py run --corpus benchmark/corpus --record
+#   python benchmark.py run --corpus benchmark/corpus --workers 1,4,8 --output results.json
+#   python benchmark.py compare baseline.json results.json
+#
+# Each worker count runs in a fresh process with empty caches, so runs don't warm each
+# other up and peak RSS is per configuration. The local card index and fingerprints are
+# left out so every lookup goes through the (replayed) Scryfall API.
+CORPUS_DIR = os.getenv('BENCHMARK_CORPUS_DIR', 'benchmark/corpus')
+LABELS_FILE = 'labels.json'
+DEFAULT_WORKERS = '1,4'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+
+def load_corpus(corpus_dir):
+    with open(os.path.join(corpus_dir, LABELS_FILE)) as f:
+        labels = json.load(f)
+    corpus = []
+    for filename in sorted(labels):
+        path = os.path.join(corpus_dir, filename)
+        if not filename.lower().endswith(IMAGE_EXTENSIONS) or not os.path.exists(path):
+            logger.warning("Skipping label without a photo", extra={'file': filename})
+            continue
+        label = labels[filename]
+        if isinstance(label, str):
+            label = {'name': label}
+        corpus.append((filename, path, label))
+    return corpus
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        'count': len(values),
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p95_ms': round(float(np.percentile(values, 95)), 2),
+        'mean_ms': round(float(values.mean()), 2),
+    }
+
+
+def parse_server_timing(header):
+    # "ocr;dur=812.3, search;dur=140.0" -> {'ocr': 0.8123, 'search': 0.14}
+    timings = {}
+    for part in (header or '').split(','):
+        name, _, duration = part.strip().partition(';dur=')
+        if name and duration:
+            timings[name] = float(duration) / 1000
+    return timings
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS. Children covers the
+    # tesseract subprocesses and the batch process pool.
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if platform.system() == 'Darwin' else 1024
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def score(result, label):
+    # Title is a case-insensitive name match; printing also needs set and number
+    name_ok = (result.get('best_match') or '').casefold() == label['name'].casefold()
+    printing_ok = None
+    if label.get('set') and label.get('collector_number'):
+        printing = result.get('printing') or {}
+        printing_ok = (name_ok
+                       and (printing.get('set') or '').casefold() == label['set'].casefold()
+                       and str(printing.get('collector_number')) == str(label['collector_number']))
+    return name_ok, printing_ok
+
+
+def measure(corpus_dir, workers, repeat):
+    # Runs inside a fresh process whose environment already points at the stand-in
+    from app import PASSWORD, app
+
+    corpus = load_corpus(corpus_dir)
+    jobs = [item for _ in range(repeat) for item in corpus]
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            local.client.post('/login', data={'password': PASSWORD})
+        return local.client
+
+    def upload(item):
+        filename, path, label = item
+        with open(path, 'rb') as f:
+            data = f.read()
+        started = time.perf_counter()
+        response = client().post('/upload?timing=1', data={'file': (io.BytesIO(data), filename)},
+                                 content_type='multipart/form-data')
+        elapsed = time.perf_counter() - started
+        result = response.get_json(silent=True) or {}
+        name_ok, printing_ok = score(result, label)
+        return {
+            'file': filename,
+            'seconds': elapsed,
+            'stages': parse_server_timing(response.headers.get('Server-Timing')),
+            'status': response.status_code,
+            'error': result.get('error'),
+            'expected': label['name'],
+            'best_match': result.get('best_match'),
+            'title_ok': name_ok,
+            'printing_ok': printing_ok,
+        }
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(upload, jobs))
+    wall = time.perf_counter() - started
+
+    stages = {}
+    for result in results:
+        for stage, seconds in result['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+    printing_scored = [r['printing_ok'] for r in results if r['printing_ok'] is not None]
+
+    return {
+        'workers': workers,
+        'requests': len(results),
+        'wall_seconds': round(wall, 3),
+        'requests_per_second': round(len(results) / wall, 3) if wall else None,
+        'latency': percentiles([r['seconds'] for r in results]),
+        'stages': {stage: percentiles(values) for stage, values in sorted(stages.items())},
+        'errors': sum(1 for r in results if r['error'] or r['status'] != 200),
+        'title_accuracy': round(sum(r['title_ok'] for r in results) / len(results), 4) if results else None,
+        'printing_accuracy': (round(sum(printing_scored) / len(printing_scored), 4)
+                              if printing_scored else None),
+        'peak_rss_mb': peak_rss_mb(),
+        'misses': [{k: r[k] for k in ('file', 'expected', 'best_match', 'error')}
+                   for r in results if not r['title_ok']],
+    }
+
+
+def run_configuration(corpus_dir, workers, repeat, api_url):
+    # One fresh process per configuration: clean caches, no index, its own peak RSS
+    with tempfile.TemporaryDirectory(prefix='nerd-market-bench-') as scratch:
+        env = dict(os.environ,
+                   SCRYFALL_API_URL=api_url,
+                   CARD_INDEX_PATH=os.path.join(scratch, 'card_index.sqlite3'),
+                   FINGERPRINT_PATH=os.path.join(scratch, 'card_fingerprints.npy'),
+                   CARD_CACHE_PATH=os.path.join(scratch, 'card_cache.sqlite3'),
+                   IMAGE_CACHE_DIR=os.path.join(scratch, 'image_cache'),
+                   DEBUG_ARTIFACTS_DIR=os.path.join(scratch, 'debug_artifacts'),
+                   # Replayed responses are local; Scryfall's rate limit would only skew req/s
+                   SCRYFALL_RATE='0',
+                   LOG_LEVEL=os.getenv('LOG_LEVEL', 'WARNING'))
+        env.pop('METRICS_DIR', None)
+        output_path = os.path.join(scratch, 'result.json')
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'measure', '--corpus', corpus_dir,
+                        '--workers', str(workers), '--repeat', str(repeat), '--output', output_path],
+                       env=env, check=True)
+        with open(output_path) as f:
+            return json.load(f)
+
+
+def run(args):
+    worker_counts = [int(n) for n in args.workers.split(',')]
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        raise SystemExit(f'No labelled photos in {args.corpus}')
+
+    runs = []
+    with StandinServer(args.fixtures, record=args.record) as standin:
+        for workers in worker_counts:
+            logger.info("Benchmarking", extra={'workers': workers, 'photos': len(corpus)})
+            runs.append(run_configuration(args.corpus, workers, args.repeat, standin.url))
+        standin_stats = standin.stats
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'corpus': os.path.abspath(args.corpus),
+        'photos': len(corpus),
+        'repeat': args.repeat,
+        'recorded': args.record,
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'fixtures': standin_stats,
+        'runs': runs,
+    }
+    if standin_stats['missing'] and not args.record:
+        logger.warning("Some requests had no recorded fixture; rerun with --record",
+                       extra={'missing': standin_stats['missing']})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print_summary(results)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(results):
+    for run in results['runs']:
+        latency = run['latency'] or {}
+        rss = run['peak_rss_mb'] or {}
+        print(f"workers={run['workers']}  {run['requests_per_second']} req/s  "
+              f"p50={latency.get('p50_ms')}ms p95={latency.get('p95_ms')}ms  "
+              f"title={run['title_accuracy']} printing={run['printing_accuracy']}  "
+              f"errors={run['errors']}  peak_rss={rss.get('self')}MB (+{rss.get('children')}MB children)")
+        for stage, stats in run['stages'].items():
+            print(f"    {stage:<14} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms")
+
+
+def compare(args):
+    # Side by side per worker count, with the relative change of the second run
+    with open(args.baseline) as f:
+        baseline = {run['workers']: run for run in json.load(f)['runs']}
+    with open(args.candidate) as f:
+        candidate = {run['workers']: run for run in json.load(f)['runs']}
+
+    def change(old, new):
+        if old is None or new is None:
+            return f'{old} -> {new}'
+        delta = f' ({(new - old) / old * 100:+.1f}%)' if old else ''
+        return f'{old} -> {new}{delta}'
+
+    for workers in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[workers], candidate[workers]
+        print(f'workers={workers}')
+        print(f"  req/s            {change(old['requests_per_second'], new['requests_per_second'])}")
+        for key in ('p50_ms', 'p95_ms'):
+            print(f"  latency {key:<8} {change((old['latency'] or {}).get(key), (new['latency'] or {}).get(key))}")
+        print(f"  title accuracy   {change(old['title_accuracy'], new['title_accuracy'])}")
+        print(f"  print accuracy   {change(old['printing_accuracy'], new['printing_accuracy'])}")
+        print(f"  peak rss (MB)    {change((old['peak_rss_mb'] or {}).get('self'), (new['peak_rss_mb'] or {}).get('self'))}")
+        for stage in sorted(set(old['stages']) | set(new['stages'])):
+            old_p95 = (old['stages'].get(stage) or {}).get('p95_ms')
+            new_p95 = (new['stages'].get(stage) or {}).get('p95_ms')
+            print(f"  {stage:<14} p95 {change(old_p95, new_p95)}")
+
+
+if __name__ == '__main__':
+    configure_logging()
+    parser = argparse.ArgumentParser(description='Offline benchmark for the card recognition pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='benchmark the corpus against recorded Scryfall fixtures')
+    run_parser.add_argument('--corpus', default=CORPUS_DIR, help='directory of photos with labels.json')
+    run_parser.add_argument('--fixtures', default=FIXTURES_DIR, help='recorded Scryfall fixtures')
+    run_parser.add_argument('--workers', default=DEFAULT_WORKERS, help='comma-separated concurrency levels')
+    run_parser.add_argument('--repeat', type=int, default=1,
+                            help='passes over the corpus per run (later passes hit the caches)')
+    run_parser.add_argument('--record', action='store_true', help='record missing fixtures from Scryfall')
+    run_parser.add_argument('--output', help='write results as JSON')
+
+    measure_parser = subparsers.add_parser('measure', help=argparse.SUPPRESS)
+    measure_parser.add_argument('--corpus', required=True)
+    measure_parser.add_argument('--workers', type=int, required=True)
+    measure_parser.add_argument('--repeat', type=int, default=1)
+    measure_parser.add_argument('--output', required=True)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'measure':
+        with open(args.output, 'w') as f:
+            json.dump(measure(args.corpus, args.workers, args.repeat), f)
+    else:
+        compare(args)
@@ -0,0 +1,259 @@
+import atexit
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from card_index import normalize_name
+from logs import get_logger
+
+logger = get_logger('card_cache')
+
+# Card/price cache shared by every gunicorn worker. SQLite in WAL mode lets readers
+# run alongside a writer from another process; writes are buffered per process and
+# flushed in batches, and the table is bounded with least-recently-used eviction.
+CACHE_PATH = os.getenv('CARD_CACHE_PATH', 'card_cache.sqlite3')
+
+# Prices change daily, card metadata (names, printings, image URLs) almost never
+TTLS = {
+    'price': int(os.getenv('CARD_CACHE_PRICE_TTL', 24 * 60 * 60)),
+    'card': int(os.getenv('CARD_CACHE_CARD_TTL', 30 * 24 * 60 * 60)),
+}
+
+MAX_ENTRIES = int(os.getenv('CARD_CACHE_MAX_ENTRIES', 50000))
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 2.0
+
+# A worker computing a coalesced result holds a lease on its key; others wait for the
+# result instead of repeating the work. Leases expire in case the holder dies.
+LEASE_SECONDS = 60
+LEASE_POLL_INTERVAL = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at);
+CREATE TABLE IF NOT EXISTS leases (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+def cache_key(title=None, set_code=None, collector_number=None, lang=None):
+    # A printing is identified by set + collector number (+ language, when it isn't
+    # English); otherwise key on the normalized title so OCR punctuation/spacing noise
+    # maps to the same entry
+    if set_code and collector_number:
+        if lang and lang != 'en':
+            return f'print:{set_code.lower()}:{collector_number.lower()}:{lang}'
+        return f'print:{set_code.lower()}:{collector_number.lower()}'
+    return f'title:{normalize_name(title or "")}'
+
+
+def prices_key(card_id):
+    # Prices are cached apart from the printing they belong to, under the Scryfall id
+    return f'prices:{card_id}'
+
+
+def result_key(upload_bytes):
+    # Identical uploads (retries, double-clicks) share one recognition result
+    return f'result:{hashlib.sha256(upload_bytes).hexdigest()}'
+
+
+class CardCache:
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES,
+                 batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.path = path
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._touched = {}
+        self._flusher = None
+        self._computing = {}
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+        atexit.register(self.flush)
+
+    def _conn(self):
+        # One connection per thread (and per process, as gunicorn forks workers)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            kind, value, expires_at = pending
+            return json.loads(value) if expires_at > now else None
+
+        row = self._conn().execute(
+            'SELECT value FROM entries WHERE key = ? AND expires_at > ?', (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        # Recency updates are batched with the writes instead of a write per read
+        with self._lock:
+            self._touched[key] = now
+        self._start_flusher()
+        return json.loads(row[0])
+
+    def set(self, key, value, kind='price', flush=False):
+        now = time.time()
+        with self._lock:
+            self._pending[key] = (kind, json.dumps(value), now + TTLS[kind])
+            full = len(self._pending) >= self.batch_size
+        if flush or full:
+            self.flush()
+        else:
+            self._start_flusher()
+
+    def delete(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._touched.pop(key, None)
+        with self._conn() as conn:
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            touched, self._touched = self._touched, {}
+        if not pending and not touched:
+            return
+        now = time.time()
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO entries (key, kind, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                [(key, kind, value, expires_at, now) for key, (kind, value, expires_at) in pending.items()],
+            )
+            conn.executemany(
+                'UPDATE entries SET accessed_at = ? WHERE key = ?',
+                [(accessed_at, key) for key, accessed_at in touched.items() if key not in pending],
+            )
+            if pending:
+                self._evict(conn, now)
+
+    def get_or_compute(self, key, compute, kind='price', cacheable=lambda value: value is not None):
+        # Returns the cached value or computes it, making sure that concurrent callers
+        # for the same key - in this process or any other worker - compute it only once
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        # Threads of this process wait on the first one's event
+        with self._lock:
+            event = self._computing.get(key)
+            leader = event is None
+            if leader:
+                event = self._computing[key] = threading.Event()
+        if not leader:
+            event.wait()
+            value = self.get(key)
+            if value is not None:
+                return value
+            # The leader failed or its result wasn't cacheable
+            value = compute()
+            if cacheable(value):
+                self.set(key, value, kind, flush=True)
+            return value
+
+        try:
+            # Other worker processes coordinate through a lease row
+            while not self._acquire_lease(key):
+                value = self._wait_for_lease(key)
+                if value is not None:
+                    return value
+            try:
+                # The previous holder may have stored the result just before releasing
+                value = self.get(key)
+                if value is not None:
+                    return value
+                value = compute()
+                if cacheable(value):
+                    self.set(key, value, kind, flush=True)
+                return value
+            finally:
+                self._release_lease(key)
+        finally:
+            with self._lock:
+                del self._computing[key]
+            event.set()
+
+    @staticmethod
+    def _lease_owner():
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def _acquire_lease(self, key):
+        now = time.time()
+        with self._conn() as conn:
+            cursor = conn.execute(
+                'INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.expires_at <= ?',
+                (key, self._lease_owner(), now + LEASE_SECONDS, now),
+            )
+            return cursor.rowcount == 1
+
+    def _release_lease(self, key):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, self._lease_owner()))
+
+    def _wait_for_lease(self, key):
+        # Poll until the holder stores the result or gives the lease up
+        conn = self._conn()
+        while True:
+            time.sleep(LEASE_POLL_INTERVAL)
+            value = self.get(key)
+            if value is not None:
+                return value
+            row = conn.execute('SELECT expires_at FROM leases WHERE key = ?', (key,)).fetchone()
+            if row is None or row[0] <= time.time():
+                return None
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM entries WHERE expires_at <= ?', (now,))
+        conn.execute('DELETE FROM leases WHERE expires_at <= ?', (now,))
+        (count,) = conn.execute('SELECT COUNT(*) FROM entries').fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                'DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)',
+                (count - self.max_entries,),
+            )
+
+    def _start_flusher(self):
+        # Background thread that flushes buffered writes every flush_interval seconds
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_loop, name='card-cache-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.warning("Card cache flush failed", extra={'error': str(e)})
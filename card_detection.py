@@ -0,0 +1,168 @@
+import cv2
+import numpy as np
+
+# Finds every card in a photo (a binder page, cards spread on a table) and warps each
+# one to a canonical upright card image, so the rest of the pipeline always sees cards
+# at the same size no matter how they were photographed.
+
+# Scryfall's "normal" image size (width, height); a card is 63 x 88 mm
+CARD_SIZE = (488, 680)
+CARD_ASPECT = 63 / 88
+
+# Accepted short/long side ratio, loose enough for some perspective distortion
+MIN_ASPECT = CARD_ASPECT * 0.75
+MAX_ASPECT = min(1.0, CARD_ASPECT * 1.25)
+
+# Ignore shapes smaller than this fraction of the frame
+MIN_AREA_RATIO = 0.005
+
+MAX_CARDS = 36
+
+
+def order_corners(points):
+    # Top-left, top-right, bottom-right, bottom-left
+    points = np.asarray(points, dtype=np.float32).reshape(4, 2)
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    ordered = np.array([
+        points[np.argmin(sums)],
+        points[np.argmin(diffs)],
+        points[np.argmax(sums)],
+        points[np.argmax(diffs)],
+    ], dtype=np.float32)
+    # A card lying sideways would warp to landscape; rotate the corners so it comes
+    # out portrait (it may still be upside down, which OCR then reports as no title)
+    top = np.linalg.norm(ordered[1] - ordered[0])
+    side = np.linalg.norm(ordered[3] - ordered[0])
+    if top > side:
+        ordered = np.roll(ordered, -1, axis=0)
+    return ordered
+
+
+def quad_for_contour(contour):
+    # Card corners are rounded, so approximate the convex hull and fall back to the
+    # minimum-area rectangle when the outline is rectangular but not exactly 4 points
+    hull = cv2.convexHull(contour)
+    approx = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+    if len(approx) == 4 and cv2.isContourConvex(approx):
+        return approx.reshape(4, 2).astype(np.float32)
+    rect = cv2.minAreaRect(contour)
+    rect_area = rect[1][0] * rect[1][1]
+    if rect_area > 0 and cv2.contourArea(hull) / rect_area > 0.9:
+        return cv2.boxPoints(rect).astype(np.float32)
+    return None
+
+
+def has_card_aspect(quad):
+    sides = [np.linalg.norm(quad[i] - quad[(i + 1) % 4]) for i in range(4)]
+    width = (sides[0] + sides[2]) / 2
+    height = (sides[1] + sides[3]) / 2
+    if min(width, height) == 0:
+        return False
+    aspect = min(width, height) / max(width, height)
+    return MIN_ASPECT <= aspect <= MAX_ASPECT
+
+
+def contains_point(quad, point):
+    return cv2.pointPolygonTest(quad.reshape(-1, 1, 2), (float(point[0]), float(point[1])), False) >= 0
+
+
+def find_card_quads(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+
+    # Edge detection with thresholds around the median brightness (dark borders on a
+    # dark table are low contrast), with small gaps in the card borders closed
+    median = float(np.median(gray))
+    edges = cv2.Canny(gray, max(10, int(0.66 * median)), max(30, int(1.33 * median)))
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8), iterations=1)
+
+    # RETR_LIST rather than RETR_EXTERNAL: on a binder page the cards sit inside the
+    # page and pocket outlines
+    contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    min_area = image.shape[0] * image.shape[1] * MIN_AREA_RATIO
+
+    candidates = []
+    for contour in contours:
+        if cv2.contourArea(contour) < min_area:
+            continue
+        quad = quad_for_contour(contour)
+        if quad is None or not has_card_aspect(quad):
+            continue
+        candidates.append((cv2.contourArea(quad), quad, quad.mean(axis=0)))
+
+    # Each edge yields an inner and an outer contour (and a border its inner edge);
+    # keep only the largest of shapes that share a centre and nearly the same area
+    distinct = []
+    for area, quad, center in sorted(candidates, key=lambda c: c[0], reverse=True):
+        if not any(area > other_area * 0.8 and np.linalg.norm(center - other_center) < np.sqrt(other_area) * 0.05
+                   for other_area, _, other_center in distinct):
+            distinct.append((area, quad, center))
+
+    # A card-shaped outline around two or more separate cards is the page, not a card
+    def is_container(area, quad):
+        inside = [(other_quad, other_center) for other_area, other_quad, other_center in distinct
+                  if other_area < area * 0.5 and contains_point(quad, other_center)]
+        return any(not contains_point(a_quad, b_center) and not contains_point(b_quad, a_center)
+                   for i, (a_quad, a_center) in enumerate(inside)
+                   for b_quad, b_center in inside[i + 1:])
+
+    candidates = [(area, quad, center) for area, quad, center in distinct if not is_container(area, quad)]
+
+    # Largest first; anything centred inside an accepted card (art box, text box, the
+    # inner edge of the same border) is part of that card
+    cards = []
+    for area, quad, center in sorted(candidates, key=lambda c: c[0], reverse=True):
+        if any(contains_point(card, center) for card in cards):
+            continue
+        cards.append(quad)
+        if len(cards) >= MAX_CARDS:
+            break
+    return cards
+
+
+def warp_card(image, quad, size=CARD_SIZE):
+    width, height = size
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(order_corners(quad), target)
+    return cv2.warpPerspective(image, matrix, size, flags=cv2.INTER_AREA)
+
+
+def find_cards(image):
+    # Card outlines in reading order
+    quads = find_card_quads(image)
+    if not quads:
+        return []
+
+    # Group into rows by centre height (half a card apart), then left to right
+    row_height = np.median([cv2.boundingRect(q.astype(np.int32))[3] for q in quads]) / 2
+    quads.sort(key=lambda q: (round(q.mean(axis=0)[1] / row_height), q.mean(axis=0)[0]))
+    return quads
+
+
+def detail_side(image, quads, size=CARD_SIZE):
+    # Long side the photo needs for its smallest card to be at least size pixels tall,
+    # so warping doesn't upscale it
+    if not quads:
+        return max(image.shape[:2])
+    card_height = min(max(np.linalg.norm(quad[0] - quad[1]), np.linalg.norm(quad[1] - quad[2]))
+                      for quad in map(order_corners, quads))
+    return int(np.ceil(max(image.shape[:2]) * max(1.0, size[1] / max(card_height, 1.0))))
+
+
+def detect_cards(image, size=CARD_SIZE, source=None, quads=None):
+    # Returns [{'polygon': [[x, y] x4], 'image': warped card}] in reading order.
+    # source is the same photo at a higher resolution to warp from; polygons are
+    # always in image's pixels.
+    if quads is None:
+        quads = find_cards(image)
+    if source is None:
+        source = image
+    scale = source.shape[1] / image.shape[1]
+    return [
+        {
+            'polygon': order_corners(quad).round().astype(int).tolist(),
+            'image': warp_card(source, quad * scale, size),
+        }
+        for quad in quads
+    ]
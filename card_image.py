@@ -0,0 +1,92 @@
+import io
+import os
+from functools import cached_property
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from image_fetch import CACHE_IMAGE_SIZE
+
+# Phone photos are 12-48 MP, far more than recognition needs. Uploads are decoded
+# straight to a working resolution: JPEGs at 1/2, 1/4 or 1/8 scale inside libjpeg
+# (DCT scaling, so the full frame is never in memory), then shrunk the rest of the way.
+# WORKING_MAX_SIDE=0 processes uploads at full resolution.
+WORKING_MAX_SIDE = int(os.getenv('WORKING_MAX_SIDE', 1600))
+
+# Largest reduction first; each is only used if it still leaves at least WORKING_MAX_SIDE
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def image_dimensions(data):
+    # (width, height) from the file header alone; PIL doesn't decode pixels until asked
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return image.size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def fit_within(image, max_side=WORKING_MAX_SIDE):
+    height, width = image.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return image
+    scale = max_side / max(height, width)
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def decode_reduced(data, max_side=WORKING_MAX_SIDE):
+    # Encoded bytes -> (BGR array whose long side is at most max_side, scale), or
+    # (None, None). Multiplying a point in the array by scale gives it in the original
+    # image's pixels.
+    buffer = np.frombuffer(data, np.uint8)
+    if buffer.size == 0:
+        return None, None
+    flags = cv2.IMREAD_COLOR
+    size = image_dimensions(data) if max_side else None
+    if size:
+        for factor, reduced_flags in REDUCED_DECODE_FLAGS:
+            if max(size) / factor >= max_side:
+                flags = reduced_flags
+                break
+    image = cv2.imdecode(buffer, flags)
+    if image is None:
+        return None, None
+    reduced = fit_within(image, max_side)
+    # Long sides, since imdecode applies the EXIF rotation and the header size doesn't
+    original_side = max(size) if size else max(image.shape[:2])
+    return reduced, original_side / max(reduced.shape[:2])
+
+
+class CardImage:
+    # One card at working resolution, with the versions derived from it for matching
+    # computed on first use and then reused for every candidate printing
+    def __init__(self, image):
+        self.image = image
+
+    @cached_property
+    def match(self):
+        # Same size as the cached candidate images and the fingerprinted printings
+        return cv2.resize(self.image, CACHE_IMAGE_SIZE, interpolation=cv2.INTER_AREA)
+
+    @cached_property
+    def match_gray(self):
+        return cv2.cvtColor(self.match, cv2.COLOR_BGR2GRAY)
+
+
+def as_card_image(image):
+    return image if isinstance(image, CardImage) else CardImage(image)
+
+
+def match_gray(image):
+    # Grayscale at match size for a CardImage (cached) or a plain BGR/gray array
+    if isinstance(image, CardImage):
+        return image.match_gray
+    if image.shape[1::-1] != CACHE_IMAGE_SIZE:
+        image = cv2.resize(image, CACHE_IMAGE_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
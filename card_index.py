@@ -0,0 +1,362 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from difflib import SequenceMatcher
+
+import numpy as np
+
+# Local card index built from a Scryfall bulk-data file (https://scryfall.com/docs/api/bulk-data).
+# Printings live in a SQLite file; the distinct card names are kept in a trigram index
+# next to it so noisy OCR titles resolve to printings without a network call.
+INDEX_PATH = os.getenv('CARD_INDEX_PATH', 'card_index.sqlite3')
+
+# Minimum fuzzy score for an OCR title to be accepted as a card name
+MIN_MATCH_SCORE = 0.5
+
+# The trigram scores shortlist this many names, which are then re-scored character by
+# character (a misread letter breaks three trigrams but only one character)
+TOP_CANDIDATES = 25
+
+# Rows are written in batches while streaming the bulk file
+WRITE_BATCH_SIZE = 2000
+
+# Whitespace and array punctuation between the objects of a bulk file
+BULK_SEPARATORS = re.compile(r'[\s\[\],]*')
+
+# Running workers check this often (seconds) whether the index was refreshed
+INDEX_RELOAD_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS printings (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    norm_name TEXT NOT NULL,
+    set_code TEXT NOT NULL,
+    collector_number TEXT NOT NULL,
+    lang TEXT NOT NULL,
+    image_url TEXT,
+    prices TEXT,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS printings_norm_name ON printings (norm_name);
+CREATE INDEX IF NOT EXISTS printings_set_number ON printings (set_code, collector_number);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def normalize_name(text):
+    # Lowercase, drop punctuation and collapse whitespace so OCR noise doesn't split keys
+    text = text.lower().replace('//', ' ')
+    text = re.sub(r'[^a-z0-9\s]', '', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def trigrams(norm_text):
+    # Pad with spaces so short names and word boundaries still produce grams
+    padded = f'  {norm_text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def card_image_url(card):
+    # Double-faced cards keep their images on the individual faces
+    if 'image_uris' in card:
+        return card['image_uris'].get('normal')
+    faces = card.get('card_faces') or []
+    if faces and 'image_uris' in faces[0]:
+        return faces[0]['image_uris'].get('normal')
+    return None
+
+
+def iter_bulk_cards(path, chunk_size=1 << 20):
+    # Stream the objects out of the bulk JSON array without loading the whole file
+    opener = gzip.open if path.endswith('.gz') else open
+    decoder = json.JSONDecoder()
+    with opener(path, 'rt', encoding='utf-8') as f:
+        buffer = ''
+        position = 0
+        eof = False
+        while True:
+            # Decode in place from an offset; the buffer is only trimmed when a chunk is read
+            position = BULK_SEPARATORS.match(buffer, position).end()
+            if position < len(buffer):
+                try:
+                    card, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # The object is cut off at the end of the chunk; read more and retry
+                else:
+                    yield card
+                    continue
+            elif eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def compact_card(card):
+    # Keep only the fields needed for lookups and pricing
+    image_url = card_image_url(card)
+    prices = json.dumps(card.get('prices') or {}, sort_keys=True)
+    row = (
+        card['id'],
+        card['name'],
+        normalize_name(card['name']),
+        card.get('set', '').lower(),
+        card.get('collector_number', '').lower(),
+        card.get('lang', 'en'),
+        image_url,
+        prices,
+    )
+    digest = hashlib.sha1('\x1f'.join(str(v) for v in row).encode('utf-8')).hexdigest()
+    return row + (digest,)
+
+
+def grams_path(index_path):
+    return os.path.splitext(index_path)[0] + '.grams.npz'
+
+
+def build_name_grams(conn, index_path):
+    # Each distinct card name is indexed under its full name and each face name,
+    # stored as a CSR-style postings list: gram -> name ids
+    names = [row[0] for row in conn.execute('SELECT DISTINCT name FROM printings ORDER BY name')]
+    postings = {}
+    alias_names = []
+    alias_norms = []
+    for name in names:
+        aliases = {normalize_name(name)}
+        if ' // ' in name:
+            aliases.update(normalize_name(face) for face in name.split(' // '))
+        for alias in aliases:
+            alias_id = len(alias_names)
+            alias_names.append(name)
+            alias_norms.append(alias)
+            for gram in trigrams(alias):
+                postings.setdefault(gram, []).append(alias_id)
+
+    grams = sorted(postings)
+    offsets = np.zeros(len(grams) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[g]) for g in grams])
+    ids = np.fromiter((i for g in grams for i in postings[g]), dtype=np.int32, count=int(offsets[-1]))
+    gram_counts = np.array([len(trigrams(a)) for a in alias_norms], dtype=np.int32)
+
+    path = grams_path(index_path)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, grams=np.array(grams), offsets=offsets, ids=ids, gram_counts=gram_counts,
+             names=np.array(alias_names), norms=np.array(alias_norms))
+    os.replace(tmp_path, path)
+
+
+def refresh_index(bulk_path, index_path=INDEX_PATH, rebuild=False):
+    # Apply a (newer) bulk file: only changed printings are written and printings that
+    # disappeared from the file are removed, so a refresh doesn't rebuild the table
+    if rebuild and os.path.exists(index_path):
+        os.remove(index_path)
+
+    conn = sqlite3.connect(index_path)
+    conn.executescript(SCHEMA)
+    existing = dict(conn.execute('SELECT id, digest FROM printings'))
+    seen = set()
+    pending = []
+    changed = 0
+    started = time.time()
+
+    def flush():
+        conn.executemany('INSERT OR REPLACE INTO printings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', pending)
+        pending.clear()
+
+    with conn:
+        for card in iter_bulk_cards(bulk_path):
+            if card.get('object') != 'card' or 'name' not in card:
+                continue
+            row = compact_card(card)
+            seen.add(row[0])
+            if existing.get(row[0]) != row[-1]:
+                pending.append(row)
+                changed += 1
+                if len(pending) >= WRITE_BATCH_SIZE:
+                    flush()
+        flush()
+
+        removed = [(card_id,) for card_id in existing if card_id not in seen]
+        conn.executemany('DELETE FROM printings WHERE id = ?', removed)
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)", (os.path.basename(bulk_path),))
+
+    if changed or removed or not os.path.exists(grams_path(index_path)):
+        build_name_grams(conn, index_path)
+
+    # Written last: running workers reload when this changes, so the new name grams
+    # have to be in place by then
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('refreshed_at', ?)", (str(time.time()),))
+    conn.close()
+
+    print(f"Card index refreshed from '{bulk_path}': {len(seen)} printings, "
+          f"{changed} written, {len(removed)} removed in {time.time() - started:.1f}s")
+    return {'printings': len(seen), 'written': changed, 'removed': len(removed)}
+
+
+def usd_sort_key(card):
+    # Match the live search's `order=usd`: most expensive first, unpriced last
+    try:
+        return -float(card['prices'].get('usd') or card['prices'].get('usd_foil'))
+    except (TypeError, ValueError):
+        return float('inf')
+
+
+class CardIndex:
+    def __init__(self, index_path=INDEX_PATH):
+        self.index_path = index_path
+        self._local = threading.local()
+        # Read before the grams, so a refresh landing in between triggers another reload
+        self.refreshed_at = self.current_refreshed_at()
+        grams = np.load(grams_path(index_path))
+        self.gram_ids = {g: i for i, g in enumerate(grams['grams'].tolist())}
+        self.offsets = grams['offsets']
+        self.ids = grams['ids']
+        self.gram_counts = grams['gram_counts']
+        self.names = grams['names'].tolist()
+        self.norms = grams['norms'].tolist()
+        self.norm_ids = {n: i for i, n in enumerate(self.norms)}
+
+    def _conn(self):
+        # SQLite connections can't be shared across threads, so keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def current_refreshed_at(self):
+        try:
+            row = self._conn().execute("SELECT value FROM meta WHERE key = 'refreshed_at'").fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def match_name(self, title):
+        # Resolve a (possibly noisy) OCR title to the closest card name and its score
+        norm = normalize_name(title)
+        if not norm:
+            return None, 0.0
+        if norm in self.norm_ids:
+            return self.names[self.norm_ids[norm]], 1.0
+
+        title_grams = [self.gram_ids[g] for g in trigrams(norm) if g in self.gram_ids]
+        if not title_grams:
+            return None, 0.0
+        postings = np.concatenate([self.ids[self.offsets[g]:self.offsets[g + 1]] for g in title_grams])
+        overlap = np.bincount(postings, minlength=len(self.names))
+        candidates = np.flatnonzero(overlap)
+        overlap = overlap[candidates]
+        gram_counts = self.gram_counts[candidates]
+
+        # Dice coefficient rewards similar lengths; containment lets a clean name win
+        # when the OCR line has extra junk around it
+        title_count = len(trigrams(norm))
+        dice = 2.0 * overlap / (gram_counts + title_count)
+        containment = np.where(gram_counts >= 6, overlap / gram_counts, 0.0)
+        scores = np.maximum(dice, 0.9 * containment)
+
+        top = np.argpartition(scores, -TOP_CANDIDATES)[-TOP_CANDIDATES:] \
+            if len(scores) > TOP_CANDIDATES else np.arange(len(scores))
+        # The final score averages both passes: characters in order rescue names whose
+        # trigrams were broken up by misread letters, trigrams keep junk from scoring
+        # well on a few scattered matching characters
+        best, score = max(((int(candidates[p]), (float(scores[p]) + self._rescore(norm, self.norms[candidates[p]])) / 2)
+                           for p in top), key=lambda c: c[1])
+        if score < MIN_MATCH_SCORE:
+            return None, score
+        return self.names[best], score
+
+    @staticmethod
+    def _rescore(norm_title, norm_name):
+        # Same two measures as the trigram pass, on characters matched in order
+        matched = sum(block.size for block in SequenceMatcher(None, norm_title, norm_name,
+                                                              autojunk=False).get_matching_blocks())
+        ratio = 2.0 * matched / (len(norm_title) + len(norm_name))
+        containment = matched / len(norm_name) if len(norm_name) >= 6 else 0.0
+        return max(ratio, 0.9 * containment)
+
+    def printings(self, name, lang='en'):
+        rows = self._conn().execute(
+            'SELECT id, name, set_code, collector_number, image_url, prices FROM printings '
+            'WHERE norm_name = ? AND lang = ? AND image_url IS NOT NULL',
+            (normalize_name(name), lang),
+        ).fetchall()
+        cards = [self._row_to_card(row) for row in rows]
+        return sorted(cards, key=usd_sort_key)
+
+    def printing(self, set_code, collector_number, lang='en'):
+        row = self._conn().execute(
+            'SELECT id, name, set_code, collector_number, image_url, prices FROM printings '
+            'WHERE set_code = ? AND collector_number = ? ORDER BY lang = ? DESC LIMIT 1',
+            (set_code.lower(), collector_number.lower(), lang),
+        ).fetchone()
+        return self._row_to_card(row) if row else None
+
+    def lookup_printings(self, title):
+        name, score = self.match_name(title)
+        if name is None:
+            return []
+        return self.printings(name)
+
+    @staticmethod
+    def _row_to_card(row):
+        card_id, name, set_code, collector_number, image_url, prices = row
+        return {
+            'id': card_id,
+            'name': name,
+            'set': set_code,
+            'collector_number': collector_number,
+            'image_url': image_url,
+            'prices': json.loads(prices),
+        }
+
+
+_card_index = None
+_card_index_checked = 0.0
+_card_index_lock = threading.Lock()
+
+
+def get_card_index():
+    # Loaded once per process and reloaded after `card_index.py refresh` has been run
+    # against it; None when no index has been built yet
+    global _card_index, _card_index_checked
+    if _card_index is not None and time.monotonic() - _card_index_checked < INDEX_RELOAD_INTERVAL:
+        return _card_index
+    with _card_index_lock:
+        if _card_index is None:
+            if os.path.exists(grams_path(INDEX_PATH)):
+                _card_index = CardIndex(INDEX_PATH)
+                _card_index_checked = time.monotonic()
+        elif time.monotonic() - _card_index_checked >= INDEX_RELOAD_INTERVAL:
+            _card_index_checked = time.monotonic()
+            if _card_index.current_refreshed_at() != _card_index.refreshed_at:
+                _card_index = CardIndex(INDEX_PATH)
+    return _card_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or refresh the local Scryfall card index.')
+    parser.add_argument('command', choices=['build', 'refresh'],
+                        help="'build' starts from scratch, 'refresh' applies only what changed")
+    parser.add_argument('bulk_file', help='Scryfall bulk-data JSON file (e.g. default-cards.json, optionally .gz)')
+    parser.add_argument('--index', default=INDEX_PATH, help='Path of the index database')
+    args = parser.parse_args()
+    refresh_index(args.bulk_file, args.index, rebuild=args.command == 'build')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import re
+
+import cv2
+import numpy as np
+
+# The collector line in a card's bottom-left corner names the exact printing:
+#
+#   184/320 M          (2015-2022 frames: number/set size, rarity)
+#   CMA • EN  Artist   (set code, language)
+#
+#   M 0002             (2023+ frames: rarity, zero-padded number, no set size)
+#   LTC • EN  Artist
+#
+# Read together, OCR usually gives "184/320 M CMA EN" or "M0002 LTC EN". Parsing that
+# into set code + collector number identifies the printing with one lookup instead of
+# comparing the photo against every printing of the card.
+
+# Bottom-left strip of an upright card (fractions of height and width). Generous, since
+# the uploaded photo is rarely cropped exactly to the card edges.
+REGION_TOP = 0.90
+REGION_BOTTOM = 0.985
+REGION_RIGHT = 0.6
+
+# Collector text is tiny; scale the strip to this height before OCR (up for small
+# card images, down for full-resolution photos)
+OCR_HEIGHT = 160
+
+# Languages as printed on the card, mapped to Scryfall's codes
+LANGUAGES = {
+    'EN': 'en', 'ES': 'es', 'SP': 'es', 'FR': 'fr', 'DE': 'de', 'IT': 'it', 'PT': 'pt',
+    'JP': 'ja', 'JA': 'ja', 'KO': 'ko', 'KR': 'ko', 'RU': 'ru', 'CS': 'zhs', 'CT': 'zht', 'PH': 'ph',
+}
+
+# Single letters only: a token like "MS" is noise, not a rarity
+RARITIES = {'C', 'U', 'R', 'M', 'S', 'L', 'T', 'P'}
+
+# "184/320", "0002", "M0002", "123a", "45★"
+NUMBER_PATTERN = re.compile(rf'^([{"".join(sorted(RARITIES))}])?(\d{{1,4}})([A-Z★]?)(?:/(\d{{1,4}}))?$')
+SET_CODE_PATTERN = re.compile(r'^(?=.*[A-Z])[A-Z0-9]{3,5}$')
+
+# OCR commonly reads the bullet between set and language as one of these
+SEPARATORS = re.compile(r'[•·*+\-—–|:;,.«»"\'`]+')
+
+
+def normalize_collector_number(number):
+    # Scryfall collector numbers drop the leading zeros printed on newer cards
+    # ("0002" -> "2") and are lowercase ("123A" -> "123a")
+    return re.sub(r'^0+(?=\d)', '', str(number).strip().lower())
+
+
+def crop_collector_region(image):
+    # BGR card image -> black-on-white grayscale strip ready for OCR
+    height, width = image.shape[:2]
+    strip = image[int(height * REGION_TOP):int(height * REGION_BOTTOM), :int(width * REGION_RIGHT)]
+    gray = cv2.cvtColor(strip, cv2.COLOR_BGR2GRAY) if strip.ndim == 3 else strip
+    if gray.size == 0:
+        return gray
+    scale = OCR_HEIGHT / gray.shape[0]
+    gray = cv2.resize(gray, None, fx=scale, fy=scale,
+                      interpolation=cv2.INTER_CUBIC if scale > 1 else cv2.INTER_AREA)
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Most borders are black with white text; Tesseract wants dark text on light
+    if np.mean(binary) < 128:
+        binary = cv2.bitwise_not(binary)
+    return binary
+
+
+def parse_collector_line(text):
+    # Returns {'set', 'collector_number', 'lang', 'rarity', 'set_size', 'confidence'}
+    # or None when no set code + collector number pair can be found
+    tokens = SEPARATORS.sub(' ', (text or '').upper()).split()
+
+    # Language first: the set code is the token right before it
+    lang_at = next((i for i in range(len(tokens) - 1, 0, -1) if tokens[i] in LANGUAGES), None)
+    if lang_at is None or not SET_CODE_PATTERN.match(tokens[lang_at - 1]):
+        return None
+    set_code = tokens[lang_at - 1]
+
+    number = None
+    for i, token in enumerate(tokens[:lang_at - 1]):
+        # "M 0002": the rarity letter can come out as its own token
+        if token in RARITIES and i + 1 < lang_at - 1 and tokens[i + 1].isdigit():
+            continue
+        match = NUMBER_PATTERN.match(token)
+        if match:
+            rarity, digits, suffix, set_size = match.groups()
+            if rarity is None and i > 0 and tokens[i - 1] in RARITIES:
+                rarity = tokens[i - 1]
+            number = (rarity, digits, suffix, set_size, i)
+            break
+    if number is None:
+        return None
+    rarity, digits, suffix, set_size, number_at = number
+
+    if rarity is None and number_at + 1 < lang_at - 1 and tokens[number_at + 1] in RARITIES:
+        rarity = tokens[number_at + 1]
+
+    collector_number = normalize_collector_number(digits + suffix)
+
+    # How sure we are this is a real collector line and not OCR noise
+    confidence = 0.5
+    if rarity:
+        confidence += 0.25
+    if set_size and int(digits) <= int(set_size):
+        confidence += 0.25
+    elif set_size:
+        confidence -= 0.25
+    elif len(digits) == 4:
+        # Zero-padded numbers only appear on the newer frames
+        confidence += 0.25
+    if number_at + 3 < lang_at:
+        # Unexplained tokens between the number and the set code
+        confidence -= 0.25
+
+    return {
+        'set': set_code.lower(),
+        'collector_number': collector_number,
+        'lang': LANGUAGES[tokens[lang_at]],
+        'rarity': rarity,
+        'set_size': int(set_size) if set_size else None,
+        'confidence': round(min(1.0, max(0.0, confidence)), 2),
+    }
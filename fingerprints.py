@@ -0,0 +1,173 @@
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from card_index import INDEX_PATH, INDEX_RELOAD_INTERVAL, CardIndex
+from image_fetch import fetch_image
+from logs import get_logger
+
+logger = get_logger('fingerprints')
+
+# Perceptual-hash fingerprints for every printing in the card index, computed offline.
+# Ids and hashes are one structured array ('id', 'hash') saved with np.save, so they are
+# replaced together and every gunicorn worker can memory-map the same file and share
+# its pages.
+FINGERPRINT_PATH = os.getenv('FINGERPRINT_PATH', 'card_fingerprints.npy')
+
+# DCT hash of HASH_SIZE x HASH_SIZE low frequencies -> HASH_SIZE**2 bits per printing
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+HASH_BYTES = HASH_BITS // 8
+
+# Popcount of every byte value, used to turn XORed hashes into Hamming distances
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+BUILD_WORKERS = 8
+
+
+def perceptual_hash(image):
+    # pHash: grayscale, shrink, DCT, then one bit per low frequency above the median
+    if image.ndim == 3:
+        image = cv2.cvtColor(image[:, :, :3], cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (HASH_SIZE * 4, HASH_SIZE * 4), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(np.float32(small))[:HASH_SIZE, :HASH_SIZE]
+    bits = dct > np.median(dct.flatten()[1:])
+    return np.packbits(bits.flatten())
+
+
+def hamming_distances(hashes, query):
+    # One vectorized pass over all candidate rows
+    return POPCOUNT[np.bitwise_xor(hashes, query)].sum(axis=1)
+
+
+def file_version(path):
+    # Changes whenever build_fingerprints swaps a new file in
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class FingerprintIndex:
+    def __init__(self, fingerprint_path=FINGERPRINT_PATH):
+        self.version = file_version(fingerprint_path)
+        records = np.load(fingerprint_path, mmap_mode='r')
+        if records.dtype.names != ('id', 'hash'):
+            raise ValueError(f"'{fingerprint_path}' is not a fingerprint file; rebuild it with fingerprints.py --rebuild")
+        self.hashes = records['hash']
+        self.ids = records['id']
+        if self.hashes.shape != (len(self.ids), HASH_BYTES):
+            raise ValueError(f"'{fingerprint_path}' has {self.hashes.shape} hashes for {len(self.ids)} ids")
+        self.rows = {card_id: row for row, card_id in enumerate(self.ids.tolist())}
+
+    def __contains__(self, card_id):
+        return card_id in self.rows
+
+    def rank(self, image, card_ids):
+        # Returns (card_id, distance) for the fingerprinted candidates, closest first
+        known = [card_id for card_id in card_ids if card_id in self.rows]
+        if not known:
+            return []
+        rows = np.fromiter((self.rows[card_id] for card_id in known), dtype=np.int64, count=len(known))
+        distances = hamming_distances(self.hashes[rows], perceptual_hash(image))
+        order = np.argsort(distances, kind='stable')
+        return [(known[i], int(distances[i])) for i in order]
+
+
+def build_fingerprints(index_path=INDEX_PATH, fingerprint_path=FINGERPRINT_PATH, rebuild=False):
+    # Fingerprint every English printing with an image; existing rows are kept unless
+    # rebuilding, so running this after a card index refresh only fetches new printings
+    card_index = CardIndex(index_path)
+    printings = card_index._conn().execute(
+        "SELECT id, image_url FROM printings WHERE lang = 'en' AND image_url IS NOT NULL"
+    ).fetchall()
+    wanted = {card_id for card_id, _ in printings}
+
+    hashes, ids = [], []
+    if not rebuild and os.path.exists(fingerprint_path):
+        try:
+            existing = FingerprintIndex(fingerprint_path)
+        except ValueError as e:
+            print(f"Ignoring existing fingerprints: {e}")
+        else:
+            keep = sorted(row for card_id, row in existing.rows.items() if card_id in wanted)
+            hashes.extend(np.array(existing.hashes[keep]))
+            ids.extend(existing.ids[keep].tolist())
+
+    done = set(ids)
+    todo = [(card_id, url) for card_id, url in printings if card_id not in done]
+    print(f"Fingerprinting {len(todo)} printings ({len(done)} already indexed)")
+
+    lock = threading.Lock()
+
+    def fingerprint(item):
+        card_id, url = item
+        try:
+            # Bypass the image cache: a full build would just churn it
+            fingerprint = perceptual_hash(fetch_image(url, cache=False))
+        except Exception as e:
+            print(f"Skipping {card_id}: {e}")
+            return
+        with lock:
+            hashes.append(fingerprint)
+            ids.append(card_id)
+
+    with ThreadPoolExecutor(max_workers=BUILD_WORKERS) as executor:
+        list(executor.map(fingerprint, todo))
+
+    id_width = max((len(card_id) for card_id in ids), default=1)
+    records = np.zeros(len(ids), dtype=[('id', f'U{id_width}'), ('hash', np.uint8, (HASH_BYTES,))])
+    records['id'] = ids
+    records['hash'] = np.array(hashes, dtype=np.uint8).reshape(-1, HASH_BYTES)
+
+    # Write next to the live file and swap it in with a single rename, so ids and
+    # hashes always change together; workers that already mapped the old file keep
+    # reading it until they reload
+    tmp_path = fingerprint_path + '.tmp.npy'
+    np.save(tmp_path, records)
+    os.replace(tmp_path, fingerprint_path)
+    print(f"Saved {len(records)} fingerprints to '{fingerprint_path}'")
+
+
+_fingerprint_index = None
+_fingerprint_index_checked = 0.0
+_fingerprint_index_lock = threading.Lock()
+
+
+def get_fingerprint_index():
+    # Memory-mapped once per process and reloaded after fingerprints.py has replaced the
+    # file; None when no (usable) fingerprints have been built yet
+    global _fingerprint_index, _fingerprint_index_checked
+    if _fingerprint_index is not None and time.monotonic() - _fingerprint_index_checked < INDEX_RELOAD_INTERVAL:
+        return _fingerprint_index
+    with _fingerprint_index_lock:
+        if _fingerprint_index is not None and time.monotonic() - _fingerprint_index_checked < INDEX_RELOAD_INTERVAL:
+            return _fingerprint_index
+        _fingerprint_index_checked = time.monotonic()
+        try:
+            version = file_version(FINGERPRINT_PATH)
+        except OSError:
+            _fingerprint_index = None
+            return None
+        if _fingerprint_index is None or _fingerprint_index.version != version:
+            try:
+                _fingerprint_index = FingerprintIndex(FINGERPRINT_PATH)
+            except (OSError, ValueError) as e:
+                logger.warning("Fingerprints unavailable", extra={'path': FINGERPRINT_PATH, 'error': str(e)})
+                _fingerprint_index = None
+    return _fingerprint_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build perceptual-hash fingerprints for the card index.')
+    parser.add_argument('--index', default=INDEX_PATH, help='Path of the card index database')
+    parser.add_argument('--output', default=FINGERPRINT_PATH, help='Path of the fingerprint array')
+    parser.add_argument('--rebuild', action='store_true', help='Recompute every fingerprint')
+    args = parser.parse_args()
+    build_fingerprints(args.index, args.output, rebuild=args.rebuild)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from logs import get_logger
+from metrics import API_ERRORS, CACHE_EVENTS
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: the size ledger is then updated without a lock
+    fcntl = None
+
+logger = get_logger('image_fetch')
+
+# Card images are fetched through one pooled session, several at a time, and kept on
+# disk already decoded and downscaled. Objects are stored by the SHA-256 of their pixels;
+# a small ref file per URL points at the object, so identical images share one file.
+# The total size of the objects is kept in a ledger file that every worker and batch
+# process updates under an flock, so the limit holds for the whole machine.
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Cached images are stored at the size compare_images works with (width, height)
+CACHE_IMAGE_SIZE = (250, 350)
+
+FETCH_WORKERS = int(os.getenv('IMAGE_FETCH_WORKERS', 8))
+FETCH_TIMEOUT = 15
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=FETCH_WORKERS)
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
+
+_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='image-fetch')
+
+_stats = {'hits': 0, 'misses': 0, 'errors': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+_eviction_lock = threading.Lock()
+
+
+def _count(counter, amount=1):
+    with _stats_lock:
+        _stats[counter] += amount
+    if counter in ('hits', 'misses'):
+        CACHE_EVENTS.inc(amount, cache='image', result='hit' if counter == 'hits' else 'miss')
+    elif counter == 'errors':
+        API_ERRORS.inc(amount, api='image_download')
+
+
+def cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _ref_path(url):
+    return os.path.join(IMAGE_CACHE_DIR, 'refs', hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def _object_path(digest):
+    return os.path.join(IMAGE_CACHE_DIR, 'objects', digest[:2], digest + '.npy')
+
+
+def _ledger_path():
+    return os.path.join(IMAGE_CACHE_DIR, 'size')
+
+
+class _Ledger:
+    # The ledger file, locked for as long as the with block runs. total is None until
+    # the cache has been measured on disk once.
+    def __enter__(self):
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        self._file = open(_ledger_path(), 'a+')
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        self._file.seek(0)
+        try:
+            self.total = int(self._file.read())
+        except ValueError:
+            self.total = None
+        return self
+
+    def save(self, total):
+        self.total = total
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(str(total))
+        self._file.flush()
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _load_cached(url):
+    try:
+        with open(_ref_path(url)) as f:
+            object_path = _object_path(f.read().strip())
+        image = np.load(object_path)
+    except (OSError, ValueError):
+        return None
+    # Touch the object so eviction sees it as recently used
+    try:
+        os.utime(object_path)
+    except OSError:
+        pass
+    return image
+
+
+def _store_cached(url, image):
+    buffer = io.BytesIO()
+    np.save(buffer, image)
+    data = buffer.getvalue()
+    digest = hashlib.sha256(image.tobytes()).hexdigest()
+    object_path = _object_path(digest)
+    try:
+        with _eviction_lock, _Ledger() as ledger:
+            if not os.path.exists(object_path):
+                _write_atomic(object_path, data)
+                if ledger.total is not None:
+                    ledger.save(ledger.total + len(data))
+            _write_atomic(_ref_path(url), digest.encode('ascii'))
+            if ledger.total is None or ledger.total > IMAGE_CACHE_MAX_BYTES:
+                _evict(ledger)
+    except OSError as e:
+        logger.warning("Could not cache image", extra={'url': url, 'error': str(e)})
+
+
+def _evict(ledger):
+    # Size-based LRU, run with the ledger locked: measure the objects on disk, drop the
+    # least recently used ones once over the limit, then the refs left pointing at
+    # nothing, and record the new total
+    objects = []
+    for root, _, files in os.walk(os.path.join(IMAGE_CACHE_DIR, 'objects')):
+        for name in files:
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            objects.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in objects)
+    evicted = 0
+    if total > IMAGE_CACHE_MAX_BYTES:
+        target = IMAGE_CACHE_MAX_BYTES * 0.9
+        for _, size, path in sorted(objects):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+            _count('evictions')
+    if evicted:
+        _remove_dangling_refs()
+    ledger.save(total)
+
+
+def _remove_dangling_refs():
+    refs_dir = os.path.join(IMAGE_CACHE_DIR, 'refs')
+    try:
+        names = os.listdir(refs_dir)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(refs_dir, name)
+        try:
+            with open(path) as f:
+                digest = f.read().strip()
+            if not os.path.exists(_object_path(digest)):
+                os.remove(path)
+        except OSError:
+            continue
+
+
+def decode_image(data, size=CACHE_IMAGE_SIZE):
+    # Decode straight to a BGR array (OpenCV channel order) and shrink it
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image')
+    if size is not None:
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image
+
+
+def fetch_image(url, cache=True):
+    if cache:
+        image = _load_cached(url)
+        if image is not None:
+            _count('hits')
+            return image
+        _count('misses')
+    try:
+        response = session.get(url, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        image = decode_image(response.content)
+    except (requests.RequestException, ValueError):
+        _count('errors')
+        raise
+    if cache:
+        _store_cached(url, image)
+    return image
+
+
+def fetch_images(urls, cache=True):
+    # Fetch concurrently on the shared bounded pool; failed downloads come back as None
+    def fetch_or_none(url):
+        try:
+            return fetch_image(url, cache=cache)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Failed to fetch image", extra={'url': url, 'error': str(e)})
+            return None
+
+    return list(_executor.map(fetch_or_none, urls))
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from flask import g, has_request_context
+
+# Structured (one JSON object per line) logging for everything under the
+# 'nerd_market' logger. LOG_LEVEL sets the starting level; share_level() changes it
+# while the app is running (see the /log-level route) by writing it to LOG_LEVEL_FILE,
+# which every worker and batch process checks every LOG_LEVEL_CHECK_INTERVAL seconds.
+# The file overrides LOG_LEVEL until it is removed.
+LOGGER_NAME = 'nerd_market'
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVEL_FILE = os.getenv('LOG_LEVEL_FILE', os.path.join(tempfile.gettempdir(), 'nerd_market_log.level'))
+LOG_LEVEL_CHECK_INTERVAL = 5
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if has_request_context() and 'request_id' in g:
+            entry['request_id'] = g.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def get_logger(name):
+    return logging.getLogger(f'{LOGGER_NAME}.{name}')
+
+
+def configure_logging():
+    logger = logging.getLogger(LOGGER_NAME)
+    if not any(isinstance(handler.formatter, JsonFormatter) for handler in logger.handlers):
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    set_level(LOG_LEVEL)
+    sync_level(force=True)
+
+
+def set_level(level):
+    # Accepts names ('debug', 'INFO'); raises ValueError for anything else
+    level = str(level).upper()
+    if level not in logging.getLevelNamesMapping():
+        raise ValueError(f'Unknown log level: {level}')
+    logging.getLogger(LOGGER_NAME).setLevel(level)
+    return level
+
+
+def get_level():
+    return logging.getLevelName(logging.getLogger(LOGGER_NAME).level)
+
+
+_level_version = None
+_level_checked = 0.0
+_level_lock = threading.Lock()
+
+
+def share_level(level):
+    # Applies the level here and writes it for every other process to pick up
+    level = set_level(level)
+    directory = os.path.dirname(LOG_LEVEL_FILE) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{LOG_LEVEL_FILE}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(level)
+    os.replace(tmp_path, LOG_LEVEL_FILE)
+    return level
+
+
+def sync_level(force=False):
+    # Applies the shared level if the file changed since this process last read it;
+    # cheap enough to call on every request
+    global _level_version, _level_checked
+    if not force and time.monotonic() - _level_checked < LOG_LEVEL_CHECK_INTERVAL:
+        return
+    with _level_lock:
+        if not force and time.monotonic() - _level_checked < LOG_LEVEL_CHECK_INTERVAL:
+            return
+        _level_checked = time.monotonic()
+        try:
+            st = os.stat(LOG_LEVEL_FILE)
+            version = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if version == _level_version:
+                return
+            with open(LOG_LEVEL_FILE) as f:
+                level = f.read().strip()
+        except OSError:
+            return
+        _level_version = version
+        try:
+            set_level(level)
+        except ValueError:
+            get_logger('logs').warning("Ignoring unknown shared log level",
+                                       extra={'path': LOG_LEVEL_FILE, 'level': level})
@@ -0,0 +1,215 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+# Minimal Prometheus instrumentation: counters and histograms rendered in the text
+# exposition format on /metrics, plus per-request stage timings for Server-Timing.
+#
+# Each gunicorn worker counts in its own memory. With METRICS_DIR set, workers also
+# dump their values there and /metrics adds up every worker's file, so a scrape that
+# lands on any worker sees the whole server.
+METRICS_DIR = os.getenv('METRICS_DIR')
+SNAPSHOT_INTERVAL = 1.0
+
+# Seconds; wide enough for both a sub-ms index lookup and a slow Scryfall round trip
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+_lock = threading.Lock()
+_last_snapshot = 0.0
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}_total{_format_labels(labels)} {_format_value(value)}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        # Stored as [count per bucket..., +Inf count, sum]
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self, values):
+        for labels, counts in sorted(values.items()):
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                yield f'{self.name}_bucket{_format_labels(labels + (("le", bound),))} {_format_value(count)}'
+            yield f'{self.name}_sum{_format_labels(labels)} {_format_value(counts[-1])}'
+            yield f'{self.name}_count{_format_labels(labels)} {_format_value(counts[-2])}'
+
+
+REQUEST_SECONDS = Histogram('nerd_market_request_seconds', 'Request latency by endpoint')
+REQUESTS = Counter('nerd_market_requests', 'Requests by endpoint and status code')
+STAGE_SECONDS = Histogram('nerd_market_stage_seconds',
+                          'Time spent per recognition stage (decode, crop, ocr, search, download, ssim, ...)')
+CACHE_EVENTS = Counter('nerd_market_cache_events', 'Cache lookups by cache and result (hit/miss)')
+CANDIDATES = Histogram('nerd_market_candidate_printings', 'Candidate printings per matched title',
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+API_ERRORS = Counter('nerd_market_api_errors', 'Failed calls to external APIs')
+COLLECTOR_LOOKUPS = Counter('nerd_market_collector_lookups',
+                            'Collector-line fast path outcomes (hit, or why it fell back to image matching)')
+
+
+_collecting = threading.local()
+
+
+@contextmanager
+def timed(stage):
+    # Records the stage in the histogram and, inside a request, for Server-Timing
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = getattr(_collecting, 'timings', None)
+        if timings is None and has_request_context():
+            timings = g.setdefault('stage_timings', {})
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def collect_timings():
+    # For work done off the request thread (pool threads, batch processes), where g
+    # isn't available: stages timed inside go into the yielded dict, which is sent back
+    # with the result and handed to add_timings
+    previous = getattr(_collecting, 'timings', None)
+    _collecting.timings = {}
+    try:
+        yield _collecting.timings
+    finally:
+        _collecting.timings = previous
+
+
+def add_timings(timings, observe=False):
+    # Adds stages collected elsewhere to this request's Server-Timing. observe=True also
+    # records them in the histogram, for timings from another process whose own
+    # metrics are never scraped.
+    for stage, elapsed in (timings or {}).items():
+        if observe:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+        if has_request_context():
+            request_timings = g.setdefault('stage_timings', {})
+            request_timings[stage] = request_timings.get(stage, 0.0) + elapsed
+
+
+def server_timing_header():
+    timings = g.get('stage_timings') if has_request_context() else None
+    if not timings:
+        return None
+    return ', '.join(f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings.items())
+
+
+def _local_values():
+    with _lock:
+        values = {metric.name: {labels: (list(v) if isinstance(v, list) else v)
+                                for labels, v in metric.values.items()}
+                  for metric in _registry}
+    return values
+
+
+def _encode(values):
+    return {name: [[list(map(list, labels)), value] for labels, value in metric_values.items()]
+            for name, metric_values in values.items()}
+
+
+def _decode(data):
+    return {name: {tuple((k, v) for k, v in labels): value for labels, value in metric_values}
+            for name, metric_values in data.items()}
+
+
+def write_snapshot(force=False):
+    # Throttled: called after every request, writes at most once per SNAPSHOT_INTERVAL
+    global _last_snapshot
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_snapshot < SNAPSHOT_INTERVAL:
+        return
+    _last_snapshot = now
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(_encode(_local_values()), f)
+    os.replace(tmp_path, path)
+
+
+def _merge(total, values):
+    for name, metric_values in values.items():
+        merged = total.setdefault(name, {})
+        for labels, value in metric_values.items():
+            if isinstance(value, list):
+                current = merged.setdefault(labels, [0] * len(value))
+                merged[labels] = [a + b for a, b in zip(current, value)]
+            else:
+                merged[labels] = merged.get(labels, 0) + value
+
+
+def render():
+    values = {}
+    if METRICS_DIR:
+        # Every worker's last snapshot, with this worker's own values fresh
+        write_snapshot(force=True)
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            try:
+                with open(path) as f:
+                    _merge(values, _decode(json.load(f)))
+            except (OSError, ValueError):
+                continue
+    else:
+        _merge(values, _local_values())
+
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.samples(values.get(metric.name, {})))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,135 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+from logs import get_logger
+
+try:
+    import tesserocr
+except ImportError:  # Optional: falls back to the pytesseract subprocess path
+    tesserocr = None
+
+logger = get_logger('ocr')
+
+# OCR engines. With tesserocr installed, a pool of Tesseract instances is initialized
+# once per process and reused, so the language model isn't reloaded on every scan.
+# Without it, pytesseract runs the tesseract binary per image as before.
+OCR_POOL_SIZE = int(os.getenv('OCR_POOL_SIZE', min(4, os.cpu_count() or 1)))
+OCR_TIMEOUT = float(os.getenv('OCR_TIMEOUT', 10))
+OCR_LANG = os.getenv('OCR_LANG', 'eng')
+
+# Tesseract page segmentation mode 6: a single uniform block of text
+DEFAULT_PSM = 6
+
+
+class OCRError(RuntimeError):
+    pass
+
+
+def to_pil(image):
+    # Engines take PIL images; accept OpenCV/numpy arrays too (grayscale or BGR)
+    if isinstance(image, np.ndarray):
+        if image.ndim == 3:
+            image = image[:, :, 2::-1]
+        return Image.fromarray(np.ascontiguousarray(image))
+    return image
+
+
+class TesserocrEngine:
+    name = 'tesserocr'
+
+    def __init__(self, pool_size=OCR_POOL_SIZE, timeout=OCR_TIMEOUT, lang=OCR_LANG):
+        self.timeout = timeout
+        self._apis = queue.Queue()
+        kwargs = {'lang': lang}
+        if os.getenv('TESSDATA_PREFIX'):
+            kwargs['path'] = os.getenv('TESSDATA_PREFIX')
+        for _ in range(pool_size):
+            self._apis.put(tesserocr.PyTessBaseAPI(**kwargs))
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='ocr')
+
+    def _recognize(self, image, psm, timeout):
+        api = self._apis.get()
+        try:
+            api.SetPageSegMode(psm)
+            api.SetImage(to_pil(image))
+            # Recognize() takes the timeout itself (ms) and stops the instance, so a stuck
+            # image can't keep it busy after images_to_strings has given up on it
+            if not api.Recognize(int(timeout * 1000)):
+                raise OCRError(f'OCR timed out after {timeout}s')
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+            self._apis.put(api)
+
+    def images_to_strings(self, images, psm=DEFAULT_PSM, timeout=None):
+        # tesserocr releases the GIL, so the pooled instances really run in parallel
+        timeout = timeout or self.timeout
+        futures = [self._executor.submit(self._recognize, image, psm, timeout) for image in images]
+        try:
+            # Images queue for a free instance, so allow the whole batch its share of waiting
+            return [future.result(timeout=timeout * len(images)) for future in futures]
+        except FutureTimeout:
+            raise OCRError(f'OCR timed out after {timeout}s')
+
+    def image_to_string(self, image, psm=DEFAULT_PSM, timeout=None):
+        return self.images_to_strings([image], psm, timeout)[0]
+
+
+class PytesseractEngine:
+    name = 'pytesseract'
+
+    def __init__(self, pool_size=OCR_POOL_SIZE, timeout=OCR_TIMEOUT, lang=OCR_LANG):
+        self.timeout = timeout
+        self.lang = lang
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='ocr')
+
+    def _recognize(self, image, psm, timeout):
+        try:
+            return pytesseract.image_to_string(to_pil(image), lang=self.lang,
+                                               config=f'--oem 3 --psm {psm}', timeout=timeout)
+        except RuntimeError as e:
+            # pytesseract reports its own timeout as a bare RuntimeError
+            raise OCRError(str(e))
+        except pytesseract.TesseractNotFoundError as e:
+            # An OSError; a missing binary fails this scan, not the whole request
+            raise OCRError(str(e))
+
+    def images_to_strings(self, images, psm=DEFAULT_PSM, timeout=None):
+        timeout = timeout or self.timeout
+        futures = [self._executor.submit(self._recognize, image, psm, timeout) for image in images]
+        return [future.result() for future in futures]
+
+    def image_to_string(self, image, psm=DEFAULT_PSM, timeout=None):
+        return self._recognize(image, psm, timeout or self.timeout)
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def create_ocr_engine(**kwargs):
+    if tesserocr is not None:
+        try:
+            return TesserocrEngine(**kwargs)
+        except RuntimeError as e:
+            logger.warning("tesserocr unavailable, falling back to pytesseract", extra={'error': str(e)})
+    return PytesseractEngine(**kwargs)
+
+
+def get_ocr_engine():
+    # One engine per process: pooled Tesseract instances and threads don't survive a fork
+    global _engine, _engine_pid
+    if _engine is None or _engine_pid != os.getpid():
+        with _engine_lock:
+            if _engine is None or _engine_pid != os.getpid():
+                _engine = create_ocr_engine()
+                _engine_pid = os.getpid()
+                logger.info("OCR engine ready", extra={'engine': _engine.name})
+    return _engine
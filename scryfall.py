@@ -0,0 +1,229 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from card_index import card_image_url
+from logs import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: the rate limit is then kept per process
+    fcntl = None
+
+logger = get_logger('scryfall')
+
+# Scryfall API client: one pooled session per process, a request rate shared by every
+# worker on the machine, retries with exponential backoff, and transparent pagination.
+# Point SCRYFALL_API_URL at a local stand-in (see scryfall_standin.py) to run offline.
+SCRYFALL_API_URL = os.getenv('SCRYFALL_API_URL', 'https://api.scryfall.com').rstrip('/')
+SCRYFALL_TIMEOUT = float(os.getenv('SCRYFALL_TIMEOUT', 10))
+
+# Scryfall asks for 50-100 ms between requests, i.e. about 10 per second
+SCRYFALL_RATE = float(os.getenv('SCRYFALL_RATE', 10))
+SCRYFALL_BURST = float(os.getenv('SCRYFALL_BURST', 10))
+
+# Token bucket state shared by all processes through this file (under an flock)
+SCRYFALL_RATE_FILE = os.getenv('SCRYFALL_RATE_FILE', os.path.join(tempfile.gettempdir(), 'nerd_market_scryfall.rate'))
+
+MAX_RETRIES = int(os.getenv('SCRYFALL_MAX_RETRIES', 3))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# /cards/collection takes at most this many identifiers per call
+COLLECTION_BATCH_SIZE = 75
+
+# Scryfall requires API clients to identify themselves
+USER_AGENT = 'NerdMarket/1.0'
+
+
+class ScryfallError(RuntimeError):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimiter:
+    # Token bucket. With fcntl the bucket lives in a small file every worker locks in
+    # turn, so gunicorn workers and batch processes share one budget; otherwise it is
+    # kept in memory for this process only.
+    def __init__(self, rate=SCRYFALL_RATE, burst=SCRYFALL_BURST, path=SCRYFALL_RATE_FILE):
+        self.rate = rate
+        self.burst = burst
+        self.path = path if fcntl is not None else None
+        self._lock = threading.Lock()
+        self._state = (burst, time.time())
+
+    def _take(self, state):
+        # Returns (new state, seconds to wait before a token is available)
+        tokens, updated = state
+        now = time.time()
+        tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+        if tokens >= 1:
+            return (tokens - 1, now), 0.0
+        return (tokens, now), (1 - tokens) / self.rate
+
+    def _take_shared(self):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = tuple(json.loads(f.read()))
+                except ValueError:
+                    state = (self.burst, time.time())
+                state, wait = self._take(state)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                wait = None
+                if self.path is not None:
+                    try:
+                        wait = self._take_shared()
+                    except OSError as e:
+                        logger.warning("Shared rate limit unavailable, limiting per process",
+                                       extra={'path': self.path, 'error': str(e)})
+                        self.path = None
+                if wait is None:
+                    self._state, wait = self._take(self._state)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+def retry_delay(attempt, response=None):
+    # Retry-After (seconds) when Scryfall sends one, else exponential backoff with jitter
+    if response is not None:
+        try:
+            return min(BACKOFF_MAX, max(0.0, float(response.headers.get('Retry-After'))))
+        except (TypeError, ValueError):
+            pass
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class ScryfallClient:
+    def __init__(self, base_url=SCRYFALL_API_URL, timeout=SCRYFALL_TIMEOUT, max_retries=MAX_RETRIES,
+                 limiter=None, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = limiter or RateLimiter()
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT, 'Accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, **kwargs):
+        # path is relative to the API ('/cards/search') or a full URL (next_page links).
+        # Returns the response for anything but 429/5xx, which are retried.
+        url = path if path.startswith(('http://', 'https://')) else self.base_url + path
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = ScryfallError(f'{method} {url} failed: {e}')
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = ScryfallError(f'{method} {url} returned {response.status_code}', response.status_code)
+            if attempt == self.max_retries:
+                raise error
+            delay = retry_delay(attempt, response)
+            logger.warning("Retrying Scryfall request", extra={'url': url, 'error': str(error),
+                                                              'attempt': attempt + 1, 'delay': round(delay, 2)})
+            time.sleep(delay)
+
+    def get_json(self, path, params=None):
+        # Parsed JSON, or None when the object doesn't exist (404)
+        response = self.request('GET', path, params=params)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise ScryfallError(f'GET {path} returned {response.status_code}', response.status_code)
+        return response.json()
+
+    def search(self, query, **params):
+        # Every matching card across all result pages; no matches is an empty list
+        page = self.get_json('/cards/search', params={'q': query, **params})
+        cards = []
+        while page is not None:
+            cards.extend(page.get('data', []))
+            if not page.get('has_more') or not page.get('next_page'):
+                break
+            page = self.get_json(page['next_page'])
+        return cards
+
+    def card(self, set_code, collector_number, lang=None):
+        # Without lang Scryfall returns its default (usually English) printing
+        path = f"/cards/{quote(set_code, safe='')}/{quote(collector_number, safe='')}"
+        if lang:
+            path += f"/{quote(lang, safe='')}"
+        return self.get_json(path)
+
+    def card_by_id(self, card_id):
+        return self.get_json(f"/cards/{quote(card_id, safe='')}")
+
+    def collection(self, identifiers):
+        # Looks up many cards at COLLECTION_BATCH_SIZE per call. identifiers are dicts as
+        # Scryfall takes them ({'id'}, {'set', 'collector_number'}, {'name'}, ...).
+        # Returns (cards, identifiers that matched nothing).
+        cards, not_found = [], []
+        for start in range(0, len(identifiers), COLLECTION_BATCH_SIZE):
+            batch = identifiers[start:start + COLLECTION_BATCH_SIZE]
+            response = self.request('POST', '/cards/collection', json={'identifiers': batch})
+            if response.status_code != 200:
+                raise ScryfallError(f'POST /cards/collection returned {response.status_code}',
+                                    response.status_code)
+            data = response.json()
+            cards.extend(data.get('data', []))
+            not_found.extend(data.get('not_found', []))
+        return cards, not_found
+
+
+def candidate_from_card(card):
+    # Scryfall card object -> the candidate dict used throughout matching
+    return {
+        'id': card.get('id'),
+        'image_url': card_image_url(card),
+        'prices': card.get('prices') or {},
+        'name': card['name'],
+        'set': card.get('set'),
+        'collector_number': card.get('collector_number')
+    }
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_scryfall_client():
+    # One client (and connection pool) per process
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = ScryfallClient()
+                _client_pid = os.getpid()
+    return _client
@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from urllib.parse import parse_qsl, urlencode
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+from logs import configure_logging, get_logger
+from scryfall import ScryfallClient, ScryfallError
+
+logger = get_logger('scryfall_standin')
+
+# A local stand-in for the Scryfall API, so the pipeline can run with no network.
+#
+# In record mode every request is forwarded to the real API and the response is saved
+# to a fixture directory; in replay mode responses come only from those fixtures and
+# anything not recorded is a 404. Card image URLs inside recorded responses are
+# rewritten to point at the stand-in, and the images are recorded the same way, so a
+# replayed run downloads nothing from the internet.
+#
+# Point the app at it with SCRYFALL_API_URL=http://127.0.0.1:<port>.
+UPSTREAM_API_URL = os.getenv('SCRYFALL_UPSTREAM_URL', 'https://api.scryfall.com')
+FIXTURES_DIR = os.getenv('SCRYFALL_FIXTURES_DIR', 'benchmark/fixtures')
+
+# Stored in fixtures in place of the stand-in's own address, which changes per run
+BASE_URL_PLACEHOLDER = '{{STANDIN}}'
+
+IMAGE_URL_PATTERN = re.compile(r'https://(?:cards|c1|c2|img)\.scryfall\.(?:io|com)/[^"\s]+')
+
+
+def fixture_key(method, path, query, body):
+    # Query parameters decoded and in a stable order, so clients that encode or order
+    # them differently hit the same fixture; POST bodies (/cards/collection) are part of the key
+    query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    digest = hashlib.sha1(f'{method} {path}?{query}\n'.encode('utf-8') + (body or b''))
+    return digest.hexdigest()
+
+
+def image_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class FixtureStore:
+    def __init__(self, path=FIXTURES_DIR):
+        self.path = path
+        self._lock = threading.Lock()
+        self._image_urls = None
+
+    def _api_path(self, key):
+        return os.path.join(self.path, 'api', key[:2], key + '.json')
+
+    def _image_path(self, key):
+        return os.path.join(self.path, 'images', key[:2], key)
+
+    def _image_urls_path(self):
+        return os.path.join(self.path, 'images.json')
+
+    def load_response(self, key):
+        try:
+            with open(self._api_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_response(self, key, method, url, status, content_type, body):
+        self._write(self._api_path(key), json.dumps({
+            'method': method,
+            'url': url,
+            'status': status,
+            'content_type': content_type,
+            'body': body,
+        }).encode('utf-8'))
+
+    def load_image(self, key):
+        try:
+            with open(self._image_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def save_image(self, key, data):
+        self._write(self._image_path(key), data)
+
+    def image_url(self, key):
+        return self.image_urls().get(key)
+
+    def image_urls(self):
+        # Stand-in image key -> original Scryfall image URL, for recording images on first request
+        with self._lock:
+            if self._image_urls is None:
+                try:
+                    with open(self._image_urls_path()) as f:
+                        self._image_urls = json.load(f)
+                except (OSError, ValueError):
+                    self._image_urls = {}
+            return self._image_urls
+
+    def add_image_urls(self, urls):
+        known = self.image_urls()
+        with self._lock:
+            new = {image_key(url): url for url in urls if image_key(url) not in known}
+            if new:
+                known.update(new)
+                self._write(self._image_urls_path(), json.dumps(known, indent=0, sort_keys=True).encode('utf-8'))
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def create_app(fixtures_dir=FIXTURES_DIR, record=False, upstream=UPSTREAM_API_URL):
+    standin = Flask(__name__)
+    store = FixtureStore(fixtures_dir)
+    # Recording goes through the real client, so it respects Scryfall's rate limit
+    upstream_client = ScryfallClient(upstream)
+    session = upstream_client.session
+    stats = {'served': 0, 'recorded': 0, 'missing': 0}
+    standin.config['STATS'] = stats
+
+    def missing(what):
+        stats['missing'] += 1
+        logger.warning("No recorded fixture", extra={'request': what})
+        return jsonify({'object': 'error', 'status': 404, 'code': 'not_found',
+                        'details': f'No recorded fixture for {what}'}), 404
+
+    def rewrite_image_urls(text):
+        urls = set(IMAGE_URL_PATTERN.findall(text))
+        store.add_image_urls(urls)
+        for url in urls:
+            text = text.replace(url, f'{BASE_URL_PLACEHOLDER}/images/{image_key(url)}')
+        return text
+
+    @standin.route('/images/<key>')
+    def image(key):
+        data = store.load_image(key)
+        if data is None and record:
+            url = store.image_url(key)
+            if url is None:
+                return missing(f'image {key}')
+            upstream_response = session.get(url, timeout=30)
+            if upstream_response.status_code != 200:
+                return Response(upstream_response.content, status=upstream_response.status_code)
+            data = upstream_response.content
+            store.save_image(key, data)
+            stats['recorded'] += 1
+        if data is None:
+            return missing(f'image {key}')
+        stats['served'] += 1
+        return Response(data, mimetype='image/jpeg')
+
+    @standin.route('/<path:path>', methods=['GET', 'POST'])
+    def api(path):
+        path = '/' + path
+        query = request.query_string.decode('utf-8')
+        body = request.get_data() if request.method == 'POST' else None
+        key = fixture_key(request.method, path, query, body)
+
+        fixture = store.load_response(key)
+        if fixture is None and record:
+            url = upstream.rstrip('/') + path + (f'?{query}' if query else '')
+            try:
+                upstream_response = upstream_client.request(
+                    request.method, url, data=body,
+                    headers={'Content-Type': request.content_type or 'application/json'})
+            except ScryfallError as e:
+                return jsonify({'object': 'error', 'status': 502, 'details': str(e)}), 502
+            # next_page links point back at the real API; send them through the stand-in too
+            text = upstream_response.text.replace(upstream.rstrip('/'), BASE_URL_PLACEHOLDER)
+            text = rewrite_image_urls(text)
+            store.save_response(key, request.method, path + (f'?{query}' if query else ''),
+                                upstream_response.status_code,
+                                upstream_response.headers.get('Content-Type', 'application/json'), text)
+            stats['recorded'] += 1
+            fixture = store.load_response(key)
+        if fixture is None:
+            return missing(f'{request.method} {request.full_path}')
+
+        stats['served'] += 1
+        body = fixture['body'].replace(BASE_URL_PLACEHOLDER, request.host_url.rstrip('/'))
+        return Response(body, status=fixture['status'], content_type=fixture['content_type'])
+
+    return standin
+
+
+class StandinServer:
+    # Runs the stand-in on a background thread; port 0 picks a free port
+    def __init__(self, fixtures_dir=FIXTURES_DIR, record=False, host='127.0.0.1', port=0):
+        self.app = create_app(fixtures_dir, record=record)
+        # Keep werkzeug's per-request access log out of benchmark output
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self._server = make_server(host, port, self.app, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='scryfall-standin', daemon=True)
+
+    @property
+    def url(self):
+        return f'http://{self._server.host}:{self._server.port}'
+
+    @property
+    def stats(self):
+        return dict(self.app.config['STATS'])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    configure_logging()
+    parser = argparse.ArgumentParser(description='Serve recorded Scryfall responses locally')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help='fixture directory')
+    parser.add_argument('--record', action='store_true', help='forward misses to Scryfall and save them')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    create_app(args.fixtures, record=args.record).run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import card_cache
+from card_cache import CardCache
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite3')
+
+
+def record_call(log_path, value, delay=0.0, fail=False):
+    # A compute function that leaves a line in log_path per call, so tests can count
+    # how often it really ran across processes
+    def compute():
+        with open(log_path, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+        time.sleep(delay)
+        if fail:
+            raise ValueError('compute failed')
+        return value
+    return compute
+
+
+def calls(log_path):
+    try:
+        with open(log_path) as f:
+            return len(f.read().split())
+    except FileNotFoundError:
+        return 0
+
+
+def get_or_compute_in_process(path, key, log_path, start_at, delay, fail):
+    # Runs in a spawned process; all of them start computing at the same moment
+    cache = CardCache(path)
+    time.sleep(max(0.0, start_at - time.time()))
+    try:
+        return cache.get_or_compute(key, record_call(log_path, {'price': '1.00'}, delay, fail))
+    except ValueError:
+        return 'failed'
+
+
+def run_in_processes(args_list):
+    with multiprocessing.get_context('spawn').Pool(len(args_list)) as pool:
+        return pool.starmap(get_or_compute_in_process, args_list)
+
+
+def test_get_or_compute_coalesces_across_processes(cache_path, tmp_path):
+    log_path = str(tmp_path / 'calls.log')
+    CardCache(cache_path)
+    start_at = time.time() + 3
+    results = run_in_processes([(cache_path, 'print:cma:184', log_path, start_at, 1.0, False)] * 4)
+
+    assert results == [{'price': '1.00'}] * 4
+    assert calls(log_path) == 1
+
+
+def test_failed_compute_releases_lease_for_other_processes(cache_path, tmp_path):
+    # The first process holds the lease and fails; the second, waiting on it, must not
+    # hang until the lease expires but compute the value itself
+    log_path = str(tmp_path / 'calls.log')
+    CardCache(cache_path)
+    start_at = time.time() + 3
+    results = run_in_processes([
+        (cache_path, 'print:cma:184', log_path, start_at, 1.0, True),
+        (cache_path, 'print:cma:184', log_path, start_at + 0.3, 0.0, False),
+    ])
+
+    assert sorted(map(str, results)) == sorted(['failed', str({'price': '1.00'})])
+    assert calls(log_path) == 2
+    with sqlite3.connect(cache_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM leases').fetchone() == (0,)
+
+
+def test_failed_compute_wakes_waiting_threads(cache_path, tmp_path):
+    cache = CardCache(cache_path)
+    log_path = str(tmp_path / 'calls.log')
+    results = {}
+
+    def leader():
+        try:
+            cache.get_or_compute('title:bolt', record_call(log_path, 'x', delay=0.5, fail=True))
+        except ValueError:
+            results['leader'] = 'failed'
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    time.sleep(0.1)
+    results['waiter'] = cache.get_or_compute('title:bolt', record_call(log_path, 'y'))
+    thread.join()
+
+    assert results == {'leader': 'failed', 'waiter': 'y'}
+    assert cache.get('title:bolt') == 'y'
+
+
+def test_expired_lease_is_taken_over(cache_path, tmp_path):
+    # A holder that died without releasing its lease only delays others until it expires
+    cache = CardCache(cache_path)
+    with sqlite3.connect(cache_path) as conn:
+        conn.execute('INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?)',
+                     ('print:cma:184', 'gone:1', time.time() + 0.5))
+
+    started = time.time()
+    value = cache.get_or_compute('print:cma:184', record_call(str(tmp_path / 'calls.log'), 'fresh'))
+
+    assert value == 'fresh'
+    assert time.time() - started >= 0.5
+    with sqlite3.connect(cache_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM leases').fetchone() == (0,)
+
+
+def test_uncacheable_result_is_not_shared(cache_path, tmp_path):
+    cache = CardCache(cache_path)
+    log_path = str(tmp_path / 'calls.log')
+    results = []
+
+    def scan():
+        results.append(cache.get_or_compute('result:abc', record_call(log_path, {'error': 'x'}, delay=0.3),
+                                            cacheable=lambda value: 'error' not in value))
+
+    threads = [threading.Thread(target=scan) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{'error': 'x'}] * 3
+    assert calls(log_path) == 3
+    assert cache.get('result:abc') is None
+
+
+def test_entries_expire_after_their_ttl(cache_path, monkeypatch):
+    cache = CardCache(cache_path)
+    cache.set('print:cma:184', {'usd': '1.00'}, 'price', flush=True)
+    cache.set('print:cma:185', {'name': 'Bolt'}, 'card', flush=True)
+    assert cache.get('print:cma:184') == {'usd': '1.00'}
+
+    monkeypatch.setitem(card_cache.TTLS, 'price', -1)
+    cache.set('print:cma:184', {'usd': '2.00'}, 'price')
+    assert cache.get('print:cma:184') is None
+    cache.flush()
+    assert cache.get('print:cma:184') is None
+    assert cache.get('print:cma:185') == {'name': 'Bolt'}
+
+    # Expired rows are dropped from the table on the next write
+    with sqlite3.connect(cache_path) as conn:
+        keys = [key for (key,) in conn.execute('SELECT key FROM entries')]
+    assert keys == ['print:cma:185']
+
+
+def test_least_recently_used_entries_are_evicted(cache_path):
+    cache = CardCache(cache_path, max_entries=3)
+    for key in ('a', 'b', 'c'):
+        cache.set(key, key, flush=True)
+        time.sleep(0.01)
+    assert cache.get('a') == 'a'
+    cache.flush()
+    time.sleep(0.01)
+    cache.set('d', 'd', flush=True)
+
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in ('a', 'c', 'd')] == ['a', 'c', 'd']
@@ -0,0 +1,104 @@
+import gzip
+import json
+import os
+import sqlite3
+
+import pytest
+
+from card_index import CardIndex, grams_path, iter_bulk_cards, refresh_index
+
+NAMES = ['Lightning Bolt', 'Lightning Helix', 'Lightning Strike', 'Ball Lightning', 'Flying Men', 'Serra Angel',
+         'Stone Rain', 'Rain of Stones', 'Pacifism', 'Delver of Secrets // Insectile Aberration']
+
+
+def bulk_card(n, name, **fields):
+    card = {'object': 'card', 'id': f'id-{n}', 'name': name, 'set': 'tst', 'collector_number': str(n),
+            'lang': 'en', 'image_uris': {'normal': f'https://img/{n}.jpg'}, 'prices': {'usd': '1.00'}}
+    card.update(fields)
+    return card
+
+
+def write_bulk(path, cards):
+    path.write_text(json.dumps(cards))
+    return str(path)
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    refresh_index(write_bulk(tmp_path / 'bulk.json', [bulk_card(n, name) for n, name in enumerate(NAMES)]), path)
+    return path
+
+
+def test_streams_cards_across_chunk_boundaries(tmp_path):
+    cards = [bulk_card(n, name) for n, name in enumerate(NAMES)]
+    path = tmp_path / 'bulk.json.gz'
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(cards, f, indent=2)
+    assert list(iter_bulk_cards(str(path), chunk_size=7)) == cards
+
+
+def test_refresh_writes_only_changes(tmp_path, index_path):
+    grams_before = os.stat(grams_path(index_path)).st_mtime_ns
+    cards = [bulk_card(n, name) for n, name in enumerate(NAMES)]
+    cards[0]['prices'] = {'usd': '2.00'}      # changed
+    del cards[1]                              # removed
+    cards.append(bulk_card(99, 'Serra Avatar'))  # added
+
+    stats = refresh_index(write_bulk(tmp_path / 'bulk.json', cards), index_path)
+
+    assert stats == {'printings': len(NAMES), 'written': 2, 'removed': 1}
+    with sqlite3.connect(index_path) as conn:
+        assert conn.execute("SELECT prices FROM printings WHERE id = 'id-0'").fetchone() == ('{"usd": "2.00"}',)
+        assert conn.execute("SELECT COUNT(*) FROM printings WHERE id = 'id-1'").fetchone() == (0,)
+    # The name grams were rebuilt: the new name resolves, the removed one doesn't
+    assert os.stat(grams_path(index_path)).st_mtime_ns != grams_before
+    index = CardIndex(index_path)
+    assert index.match_name('Serra Avatar') == ('Serra Avatar', 1.0)
+    assert index.match_name('Lightning Helix')[0] != 'Lightning Helix'
+
+
+def test_unchanged_refresh_writes_nothing(tmp_path, index_path):
+    grams_before = os.stat(grams_path(index_path)).st_mtime_ns
+    refreshed_before = CardIndex(index_path).refreshed_at
+    cards = [bulk_card(n, name) for n, name in enumerate(NAMES)]
+
+    stats = refresh_index(write_bulk(tmp_path / 'bulk.json', cards), index_path)
+
+    assert stats == {'printings': len(NAMES), 'written': 0, 'removed': 0}
+    assert os.stat(grams_path(index_path)).st_mtime_ns == grams_before
+    # Still marked as refreshed, so running workers reload
+    assert CardIndex(index_path).refreshed_at != refreshed_before
+
+
+@pytest.mark.parametrize('title, name', [
+    ('Lightning Bolt', 'Lightning Bolt'),
+    ('Pa Flying Lightning Bolt', 'Lightning Bolt'),
+    ('Lightning Bolt ~ 1R', 'Lightning Bolt'),
+    ('Lightnlng Bolt', 'Lightning Bolt'),
+    ('Lrghtmng Bo1t', 'Lightning Bolt'),
+    ('Ljghtnjng Strjke', 'Lightning Strike'),
+    ('Pa Flying Men', 'Flying Men'),
+    ('Serra Anqel', 'Serra Angel'),
+    ('Stonc Raln', 'Stone Rain'),
+    ('Delver of Secrets', 'Delver of Secrets // Insectile Aberration'),
+    ('Insectile Aberration', 'Delver of Secrets // Insectile Aberration'),
+])
+def test_noisy_titles_resolve(index_path, title, name):
+    assert CardIndex(index_path).match_name(title)[0] == name
+
+
+@pytest.mark.parametrize('title', ['', 'Instant', 'Draw a card', 'Creature Human Wizard', 'the quick brown fox'])
+def test_junk_titles_match_nothing(index_path, title):
+    assert CardIndex(index_path).match_name(title)[0] is None
+
+
+def test_printing_prefers_requested_language(tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    refresh_index(write_bulk(tmp_path / 'bulk.json', [
+        bulk_card(1, 'Sol Ring', id='en-1', collector_number='184'),
+        bulk_card(2, 'Sol Ring', id='ja-1', collector_number='184', lang='ja'),
+    ]), path)
+    index = CardIndex(path)
+    assert index.printing('TST', '184', 'ja')['id'] == 'ja-1'
+    assert index.printing('tst', '184')['id'] == 'en-1'
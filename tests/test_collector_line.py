@@ -0,0 +1,55 @@
+import pytest
+
+from collector_line import normalize_collector_number, parse_collector_line
+
+
+def test_parses_number_over_set_size_frame():
+    assert parse_collector_line('184/320 M CMA • EN') == {
+        'set': 'cma', 'collector_number': '184', 'lang': 'en', 'rarity': 'M', 'set_size': 320, 'confidence': 1.0,
+    }
+
+
+@pytest.mark.parametrize('text', ['M 0002 LTC • EN', 'M0002 LTC EN', '0002 M LTC · EN'])
+def test_parses_zero_padded_frame(text):
+    assert parse_collector_line(text) == {
+        'set': 'ltc', 'collector_number': '2', 'lang': 'en', 'rarity': 'M', 'set_size': None, 'confidence': 1.0,
+    }
+
+
+def test_ignores_artist_after_language():
+    collector = parse_collector_line('184/320 M CMA · EN Christopher Rahn')
+    assert (collector['set'], collector['collector_number'], collector['lang']) == ('cma', '184', 'en')
+
+
+def test_maps_printed_language_to_scryfall_code():
+    assert parse_collector_line('R 0045 CMM • FR')['lang'] == 'fr'
+    assert parse_collector_line('R 0045 CMM • JP')['lang'] == 'ja'
+
+
+def test_keeps_lowercase_suffix():
+    assert parse_collector_line('0123a R DOM EN')['collector_number'] == '123a'
+
+
+@pytest.mark.parametrize('text', [None, '', 'Lightning Bolt', '184/320 M', 'CMA EN', '184/320 M CM EN'])
+def test_rejects_text_without_set_and_number(text):
+    assert parse_collector_line(text) is None
+
+
+def test_multi_letter_token_is_not_a_rarity():
+    collector = parse_collector_line('123 MS CMA EN')
+    assert collector['rarity'] is None
+    assert collector['confidence'] == 0.5
+
+
+def test_number_above_set_size_lowers_confidence():
+    assert parse_collector_line('999/320 M CMA EN')['confidence'] == 0.5
+
+
+def test_stray_tokens_before_set_code_lower_confidence():
+    assert parse_collector_line('184/320 M xx yy CMA EN')['confidence'] == 0.75
+
+
+@pytest.mark.parametrize('number, expected', [('0002', '2'), ('184', '184'), ('0123A', '123a'), ('0', '0'),
+                                              (' 45★ ', '45★'), ('A-0012', 'a-0012')])
+def test_normalize_collector_number(number, expected):
+    assert normalize_collector_number(number) == expected
@@ -0,0 +1,76 @@
+import json
+import zlib
+
+import numpy as np
+import pytest
+
+import fingerprints
+from card_index import refresh_index
+from fingerprints import FingerprintIndex, build_fingerprints
+
+
+def card_art(url):
+    # A distinct, repeatable image per URL
+    rng = np.random.default_rng(zlib.crc32(url.encode('utf-8')))
+    return rng.integers(0, 256, (680, 488, 3), dtype=np.uint8)
+
+
+def write_bulk(path, ids):
+    cards = [{'object': 'card', 'id': card_id, 'name': f'Card {card_id}', 'set': 'tst',
+              'collector_number': str(n), 'lang': 'en', 'image_uris': {'normal': f'https://img/{card_id}.jpg'}}
+             for n, card_id in enumerate(ids, 1)]
+    path.write_text(json.dumps(cards))
+    return str(path)
+
+
+@pytest.fixture
+def index_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprints, 'fetch_image', lambda url, cache=True: card_art(url))
+    return str(tmp_path / 'index.sqlite3')
+
+
+def test_ids_and_hashes_are_stored_together(tmp_path, index_path):
+    refresh_index(write_bulk(tmp_path / 'bulk.json', ['a', 'b', 'c']), index_path)
+    path = str(tmp_path / 'fp.npy')
+    build_fingerprints(index_path, path)
+
+    index = FingerprintIndex(path)
+    assert sorted(index.ids.tolist()) == ['a', 'b', 'c']
+    assert index.hashes.shape == (3, fingerprints.HASH_BYTES)
+    assert index.rank(card_art('https://img/b.jpg'), ['a', 'b', 'c'])[0] == ('b', 0)
+
+
+def test_incremental_build_keeps_rows_aligned(tmp_path, index_path):
+    path = str(tmp_path / 'fp.npy')
+    refresh_index(write_bulk(tmp_path / 'bulk.json', ['a', 'b', 'c']), index_path)
+    build_fingerprints(index_path, path)
+    refresh_index(write_bulk(tmp_path / 'bulk.json', ['b', 'c', 'd']), index_path)
+    build_fingerprints(index_path, path)
+
+    index = FingerprintIndex(path)
+    assert sorted(index.ids.tolist()) == ['b', 'c', 'd']
+    for card_id in ('b', 'c', 'd'):
+        assert index.rank(card_art(f'https://img/{card_id}.jpg'), ['b', 'c', 'd'])[0] == (card_id, 0)
+
+
+def test_rejects_files_in_the_old_format(tmp_path):
+    path = str(tmp_path / 'fp.npy')
+    np.save(path, np.zeros((2, fingerprints.HASH_BYTES), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        FingerprintIndex(path)
+
+
+def test_workers_reload_a_rebuilt_file(tmp_path, index_path, monkeypatch):
+    path = str(tmp_path / 'fp.npy')
+    monkeypatch.setattr(fingerprints, 'FINGERPRINT_PATH', path)
+    monkeypatch.setattr(fingerprints, 'INDEX_RELOAD_INTERVAL', 0)
+    monkeypatch.setattr(fingerprints, '_fingerprint_index', None)
+    assert fingerprints.get_fingerprint_index() is None
+
+    refresh_index(write_bulk(tmp_path / 'bulk.json', ['a']), index_path)
+    build_fingerprints(index_path, path)
+    assert fingerprints.get_fingerprint_index().ids.tolist() == ['a']
+
+    refresh_index(write_bulk(tmp_path / 'bulk.json', ['a', 'b']), index_path)
+    build_fingerprints(index_path, path)
+    assert sorted(fingerprints.get_fingerprint_index().ids.tolist()) == ['a', 'b']
@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import image_fetch
+
+
+def image_for(n):
+    return np.full((350, 250, 3), n % 256, dtype=np.uint8)
+
+
+# Each cached object is this many bytes (the array plus the .npy header)
+OBJECT_BYTES = 350 * 250 * 3 + 128
+
+
+def objects_on_disk(cache_dir):
+    return [os.path.join(root, name) for root, _, files in os.walk(os.path.join(cache_dir, 'objects'))
+            for name in files if name.endswith('.npy')]
+
+
+def refs_on_disk(cache_dir):
+    return os.listdir(os.path.join(cache_dir, 'refs'))
+
+
+def store_in_process(cache_dir, max_bytes, numbers):
+    image_fetch.IMAGE_CACHE_DIR = cache_dir
+    image_fetch.IMAGE_CACHE_MAX_BYTES = max_bytes
+    for n in numbers:
+        image_fetch._store_cached(f'https://img/{n}.jpg', image_for(n))
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    path = str(tmp_path / 'image_cache')
+    monkeypatch.setattr(image_fetch, 'IMAGE_CACHE_DIR', path)
+    monkeypatch.setattr(image_fetch, 'IMAGE_CACHE_MAX_BYTES', OBJECT_BYTES * 10)
+    return path
+
+
+def test_evicts_least_recently_used_and_their_refs(cache_dir):
+    def object_of(n):
+        with open(image_fetch._ref_path(f'https://img/{n}.jpg')) as f:
+            return image_fetch._object_path(f.read())
+
+    # Fill the cache exactly, with 0 the most recently used and 1 the least
+    for n in range(10):
+        image_fetch._store_cached(f'https://img/{n}.jpg', image_for(n))
+        os.utime(object_of(n), (1000 + n, 1000 + n))
+    os.utime(object_of(0), (2000, 2000))
+
+    image_fetch._store_cached('https://img/10.jpg', image_for(10))
+
+    assert sum(os.path.getsize(path) for path in objects_on_disk(cache_dir)) <= OBJECT_BYTES * 10
+    assert image_fetch._load_cached('https://img/0.jpg') is not None
+    assert image_fetch._load_cached('https://img/1.jpg') is None
+    # No ref outlives its object
+    assert len(refs_on_disk(cache_dir)) == len(objects_on_disk(cache_dir))
+
+
+def test_identical_images_share_one_object(cache_dir):
+    image_fetch._store_cached('https://img/a.jpg', image_for(1))
+    image_fetch._store_cached('https://img/b.jpg', image_for(1))
+    assert len(objects_on_disk(cache_dir)) == 1
+    with open(image_fetch._ledger_path()) as f:
+        assert int(f.read()) == os.path.getsize(objects_on_disk(cache_dir)[0])
+
+
+def test_limit_holds_across_processes(cache_dir):
+    max_bytes = OBJECT_BYTES * 10
+    batches = [range(i * 20, i * 20 + 20) for i in range(4)]
+    with multiprocessing.get_context('spawn').Pool(4) as pool:
+        pool.starmap(store_in_process, [(cache_dir, max_bytes, list(batch)) for batch in batches])
+
+    assert sum(os.path.getsize(path) for path in objects_on_disk(cache_dir)) <= max_bytes
+    assert len(refs_on_disk(cache_dir)) == len(objects_on_disk(cache_dir))
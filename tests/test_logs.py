@@ -0,0 +1,61 @@
+import logging
+import os
+
+import pytest
+
+import logs
+
+
+@pytest.fixture
+def level_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'log.level')
+    monkeypatch.setattr(logs, 'LOG_LEVEL_FILE', path)
+    monkeypatch.setattr(logs, '_level_version', None)
+    monkeypatch.setattr(logs, '_level_checked', 0.0)
+    logger = logging.getLogger(logs.LOGGER_NAME)
+    level = logger.level
+    yield path
+    logger.setLevel(level)
+
+
+def test_shared_level_reaches_other_processes(level_file, monkeypatch):
+    logs.set_level('INFO')
+    assert logs.share_level('debug') == 'DEBUG'
+    assert open(level_file).read() == 'DEBUG'
+
+    # Another worker: still at its own level until it checks the file
+    logs.set_level('WARNING')
+    monkeypatch.setattr(logs, '_level_version', None)
+    logs.sync_level()
+    assert logs.get_level() == 'DEBUG'
+
+
+def test_sync_waits_for_check_interval(level_file):
+    logs.share_level('ERROR')
+    logs.sync_level(force=True)
+    logs.set_level('INFO')
+    with open(level_file, 'w') as f:
+        f.write('DEBUG')
+    os.utime(level_file, ns=(1, 1))
+    logs.sync_level()
+    assert logs.get_level() == 'INFO'
+    logs.sync_level(force=True)
+    assert logs.get_level() == 'DEBUG'
+
+
+def test_unknown_levels_are_rejected(level_file):
+    logs.set_level('INFO')
+    with pytest.raises(ValueError):
+        logs.share_level('chatty')
+    assert not os.path.exists(level_file)
+
+    with open(level_file, 'w') as f:
+        f.write('CHATTY')
+    logs.sync_level(force=True)
+    assert logs.get_level() == 'INFO'
+
+
+def test_missing_file_keeps_current_level(level_file):
+    logs.set_level('WARNING')
+    logs.sync_level(force=True)
+    assert logs.get_level() == 'WARNING'
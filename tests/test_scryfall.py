@@ -0,0 +1,132 @@
+import json
+import multiprocessing
+import threading
+import time
+
+import pytest
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from scryfall import RateLimiter, ScryfallClient
+
+
+def card(n):
+    return {'object': 'card', 'id': f'id-{n}', 'name': f'Card {n}', 'set': 'tst', 'collector_number': str(n)}
+
+
+def create_stub():
+    stub = Flask(__name__)
+    stub.config['CALLS'] = calls = []
+
+    @stub.before_request
+    def record():
+        calls.append((request.method, request.path, request.get_json(silent=True)))
+
+    @stub.route('/cards/search')
+    def search():
+        # Three pages of two cards
+        page = int(request.args.get('page', 1))
+        body = {'object': 'list', 'data': [card(page * 2 - 1), card(page * 2)], 'has_more': page < 3}
+        if page < 3:
+            body['next_page'] = f"{request.host_url}cards/search?q={request.args['q']}&page={page + 1}"
+        return jsonify(body)
+
+    @stub.route('/cards/<set_code>/<number>')
+    def printing(set_code, number):
+        if number == '404':
+            return jsonify({'object': 'error', 'status': 404}), 404
+        return jsonify(card(int(number)))
+
+    @stub.route('/cards/limited')
+    def limited():
+        # Rate limited on the first call
+        if sum(1 for _, path, _ in calls if path == '/cards/limited') == 1:
+            return jsonify({'object': 'error', 'status': 429}), 429, {'Retry-After': '0.3'}
+        return jsonify(card(1))
+
+    @stub.route('/cards/collection', methods=['POST'])
+    def collection():
+        identifiers = request.get_json()['identifiers']
+        found = [card(int(i['collector_number'])) for i in identifiers if i['collector_number'] != '0']
+        not_found = [i for i in identifiers if i['collector_number'] == '0']
+        return jsonify({'object': 'list', 'data': found, 'not_found': not_found})
+
+    return stub
+
+
+@pytest.fixture
+def stub():
+    app = create_stub()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.port}', app.config['CALLS']
+    server.shutdown()
+    thread.join()
+
+
+@pytest.fixture
+def client(stub, tmp_path):
+    url, _ = stub
+    return ScryfallClient(url, max_retries=2, limiter=RateLimiter(rate=0, path=str(tmp_path / 'rate')))
+
+
+def test_search_follows_every_page(client, stub):
+    _, calls = stub
+    cards = client.search('card')
+    assert [c['id'] for c in cards] == [f'id-{n}' for n in range(1, 7)]
+    assert len(calls) == 3
+
+
+def test_missing_card_is_none(client):
+    assert client.card('tst', '404') is None
+    assert client.card('tst', '7')['name'] == 'Card 7'
+
+
+def test_retries_after_429_honouring_retry_after(client, stub):
+    _, calls = stub
+    started = time.monotonic()
+    assert client.get_json('/cards/limited')['id'] == 'id-1'
+    assert time.monotonic() - started >= 0.3
+    assert len(calls) == 2
+
+
+def test_collection_is_split_into_batches_of_75(client, stub):
+    _, calls = stub
+    identifiers = [{'set': 'tst', 'collector_number': str(n)} for n in range(160)]
+    cards, not_found = client.collection(identifiers)
+
+    assert [len(body['identifiers']) for method, path, body in calls] == [75, 75, 10]
+    assert len(cards) == 159
+    assert not_found == [{'set': 'tst', 'collector_number': '0'}]
+
+
+def test_rate_limiter_paces_requests(tmp_path):
+    limiter = RateLimiter(rate=20, burst=1, path=str(tmp_path / 'rate'))
+    started = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    # The first token is the burst, the other ten come 50 ms apart
+    assert time.monotonic() - started >= 0.45
+
+
+def acquire_in_process(path, count, start_at):
+    limiter = RateLimiter(rate=20, burst=1, path=path)
+    time.sleep(max(0.0, start_at - time.time()))
+    stamps = []
+    for _ in range(count):
+        limiter.acquire()
+        stamps.append(time.time())
+    return stamps
+
+
+def test_rate_limit_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'rate')
+    start_at = time.time() + 3
+    with multiprocessing.get_context('spawn').Pool(3) as pool:
+        results = pool.starmap(acquire_in_process, [(path, 6, start_at)] * 3)
+    # All processes draw from one bucket: however they interleave, no two requests go
+    # out closer than 1/rate apart (allowing for timer jitter)
+    stamps = sorted(t for result in results for t in result)
+    gaps = [b - a for a, b in zip(stamps, stamps[1:])]
+    assert min(gaps) >= 0.04